@@ -1,34 +1,102 @@
-# file: ai_connector.py (针对性修正版)
+# file: ai_connector.py (延迟初始化版)
 
-import openai
 import os
-from dotenv import load_dotenv
 import base64
 import io
 from PIL import Image
 import json
+import hashlib
+import time
+import asyncio
+import random
+import threading
+from collections import namedtuple
+from functools import lru_cache
 
-# --- 1. 加载环境变量 ---
-load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-base_url = os.getenv("OPENAI_API_BASE")
+import tracing
 
-# 检查配置是否齐全
-if not api_key or not base_url:
-    raise ValueError("错误：请在 .env 文件中设置好 OPENAI_API_KEY 和 OPENAI_API_BASE")
+# 导入本模块不会产生任何副作用：.env 在第一次需要配置时才加载，
+# openai 和 python-dotenv 也在第一次使用时才导入，没有配置AI也能正常使用布局和滤镜功能。
 
-client = openai.OpenAI(api_key=api_key, base_url=base_url)
+# --- 1. 视觉模型名称 ---
+# 警告：您示例中的 "Qwen/Qwen2.5-72B-Instruct" 很可能不支持视觉。
+# 您需要查找服务商文档，找到类似 Qwen-VL, Yi-VL, LLaVA 等多模态模型。
+# 我在这里先使用一个常见的开源视觉模型名称作为示例，您需要替换成您可用的模型。
+VISION_MODEL_NAME = "stepfun-ai/step3"  # <--- 请在这里填入您服务商提供的【正确视觉模型】名称！
 
+# --- 2. JPEG 质量的搜索范围（发送给AI的图片负载） ---
+JPEG_QUALITY_MAX = 90
+JPEG_QUALITY_MIN = 40
 
-def generate_prompt(content_style, num_photos):
-    # ... 这个函数保持不变 ...
+# --- 3. AI文字缓存的淘汰 ---
+CACHE_RESCAN_WRITES = 256   # 每写入这么多次才完整扫描一次缓存目录，校正其他进程写入造成的偏差
+CACHE_EVICT_TARGET = 0.9    # 超出上限时淘汰到上限的90%，之后的若干次写入都不需要再扫描
+
+# 所有可以在 .env 中配置的选项，含义见 .env.example
+AISettings = namedtuple("AISettings", [
+    "api_key", "base_url",
+    "cache_dir", "cache_max_bytes", "cache_enabled",    # AI文字缓存
+    "image_max_edge", "image_byte_budget",              # 图片负载：最长边像素数、所有图片加起来的字节预算
+    "concurrency", "rate_limit", "request_timeout", "max_retries",  # 批量并发请求
+])
+
+
+_cache_size_lock = threading.Lock()
+_cache_sizes = {}  # 缓存目录 -> [估算的总字节数, 上次扫描后的写入次数]
+
+
+@lru_cache(maxsize=None)
+def get_settings():
+    """【延迟加载配置】第一次调用时加载 .env 文件并读取所有配置，之后直接返回同一份结果"""
+    from dotenv import load_dotenv
+    load_dotenv()
+    return AISettings(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv("OPENAI_API_BASE"),
+        cache_dir=os.getenv("AI_CACHE_DIR", os.path.join(".cache", "ai_texts")),
+        cache_max_bytes=int(os.getenv("AI_CACHE_MAX_BYTES", str(20 * 1024 * 1024))),
+        cache_enabled=os.getenv("AI_CACHE_DISABLED", "").lower() not in ("1", "true", "yes"),
+        image_max_edge=int(os.getenv("AI_IMAGE_MAX_EDGE", "1280")),
+        image_byte_budget=int(os.getenv("AI_IMAGE_BYTE_BUDGET", str(400 * 1024))),
+        concurrency=int(os.getenv("AI_CONCURRENCY", "4")),
+        rate_limit=float(os.getenv("AI_RATE_LIMIT", "2")),
+        request_timeout=float(os.getenv("AI_REQUEST_TIMEOUT", "60")),
+        max_retries=int(os.getenv("AI_MAX_RETRIES", "3")),
+    )
+
+
+def get_credentials():
+    """返回 (api_key, base_url)，配置不齐全时抛出 ValueError"""
+    settings = get_settings()
+    # 检查配置是否齐全
+    if not settings.api_key or not settings.base_url:
+        raise ValueError("错误：请在 .env 文件中设置好 OPENAI_API_KEY 和 OPENAI_API_BASE")
+    return settings.api_key, settings.base_url
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """【客户端工厂】第一次调用时才导入 openai 并创建同步客户端，之后复用同一个实例"""
+    import openai
+    api_key, base_url = get_credentials()
+    return openai.OpenAI(api_key=api_key, base_url=base_url)
+
+
+def generate_prompt(content_style, num_photos, separate_images=False):
+    # separate_images 为 True 时，每张照片作为单独的图片发送，而不是一整张拼接图
     prompts = {
         "简体短句": "请为图片生成一句有电影感的简体中文短句。",
         "繁体诗歌": "請為圖片創作一句充滿詩意、富有想像的繁體中文詩。",
         "英文散文": "Please write a short, atmospheric, and poetic sentence in English for the image."
     }
     base_prompt = prompts.get(content_style, prompts["简体短句"])
-    if num_photos > 1:
+    if num_photos > 1 and separate_images:
+        return (f"下面按顺序给出了{num_photos}张照片。"
+                f"请你按顺序，分别为每一张照片生成一句对应的文字描述。"
+                f"文字风格要求：{base_prompt}"
+                f"请严格按照这个JSON格式返回，不要有任何额外说明: "
+                f"{{\"texts\": [\"第一张照片的文字\", \"第二张照片的文字\", \"第三张照片的文字\"]}}")
+    elif num_photos > 1:
         return (f"这是一组由{num_photos}张照片拼接而成的图片。"
                 f"请你从上到下，分别为每一张照片生成一句对应的文字描述。"
                 f"文字风格要求：{base_prompt}"
@@ -40,56 +108,368 @@ def generate_prompt(content_style, num_photos):
                 f"{{\"texts\": [\"文字内容\"]}}")
 
 
-def get_ai_text(image: Image.Image, content_style: str, num_photos: int):
+def encode_jpeg_for_budget(image, max_edge, byte_budget):
+    """
+    把一张图片缩小到最长边不超过 max_edge，并用二分查找选出编码后不超过 byte_budget 的最高JPEG质量。
+    最低质量仍然超出预算时，继续缩小图片再试。返回 (JPEG字节, 质量)。
+    """
+    image = image.convert("RGB")
+    scale = max_edge / max(image.size)
+    while True:
+        if scale < 1:
+            new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            candidate = image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        else:
+            candidate = image
+
+        def encode(quality):
+            buffered = io.BytesIO()
+            candidate.save(buffered, format="JPEG", quality=quality)
+            return buffered.getvalue()
+
+        # 大多数情况下最高质量就能放进预算，只需编码一次
+        best_bytes, best_quality = encode(JPEG_QUALITY_MAX), JPEG_QUALITY_MAX
+        if len(best_bytes) > byte_budget:
+            best_bytes, best_quality = None, None
+            low, high = JPEG_QUALITY_MIN, JPEG_QUALITY_MAX - 1
+            while low <= high:
+                quality = (low + high) // 2
+                data = encode(quality)
+                if len(data) <= byte_budget:
+                    best_bytes, best_quality = data, quality
+                    low = quality + 1
+                else:
+                    high = quality - 1
+
+        if best_bytes is not None:
+            return best_bytes, best_quality
+        if max(candidate.size) <= 64:
+            # 图片已经很小了，不再继续缩小，直接用最低质量
+            return encode(JPEG_QUALITY_MIN), JPEG_QUALITY_MIN
+        scale = min(scale, 1.0) * 0.75
+
+
+def build_image_payload(image, frames=None, max_edge=None, byte_budget=None):
+    """
+    【图片负载构建】把要发送给AI的图片编码成JPEG字节列表。
+    frames 不为空时逐张发送每一帧照片，否则发送整张拼接图；字节预算在各张图片之间平均分配。
+    返回字典: images（JPEG字节列表）、qualities、encoded_bytes（总字节数）、encode_seconds（编码耗时）。
+    """
+    max_edge = max_edge or get_settings().image_max_edge
+    byte_budget = byte_budget or get_settings().image_byte_budget
+    sources = list(frames) if frames else [image]
+
+    start_time = time.perf_counter()
+    encoded = [encode_jpeg_for_budget(img, max_edge, byte_budget // len(sources)) for img in sources]
+    payload = {
+        "images": [data for data, _ in encoded],
+        "qualities": [quality for _, quality in encoded],
+        "encoded_bytes": sum(len(data) for data, _ in encoded),
+        "encode_seconds": time.perf_counter() - start_time,
+    }
+    print(f"图片负载: {len(sources)} 张, 共 {payload['encoded_bytes'] / 1024:.1f} KB, "
+          f"JPEG质量 {payload['qualities']}, 编码耗时 {payload['encode_seconds'] * 1000:.0f} ms")
+    return payload
+
+
+def get_cache_key(image_bytes_list, content_style, num_photos, model_name, prompt):
+    """用实际发送的图片字节、文字风格、照片数量、模型和提示词计算内容哈希，作为缓存键"""
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([content_style, num_photos, model_name, prompt], ensure_ascii=False).encode("utf-8"))
+    for image_bytes in image_bytes_list:
+        hasher.update(len(image_bytes).to_bytes(8, "little"))
+        hasher.update(image_bytes)
+    return hasher.hexdigest()
+
+
+def read_cached_texts(cache_key):
+    """读取缓存的AI文字，未命中或缓存损坏时返回 None"""
+    cache_path = os.path.join(get_settings().cache_dir, f"{cache_key}.json")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            texts = json.load(f)["texts"]
+        os.utime(cache_path)  # 更新修改时间，淘汰时按最近使用排序
+        return texts
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_cached_texts(cache_key, texts):
+    """写入缓存（先写临时文件再改名），缓存总大小超出容量上限时按最近使用顺序淘汰旧缓存"""
+    settings = get_settings()
+    cache_path = os.path.join(settings.cache_dir, f"{cache_key}.json")
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(settings.cache_dir, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"texts": texts, "created": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+        track_cache_write(settings.cache_dir, settings.cache_max_bytes, os.path.getsize(cache_path))
+    except OSError as e:
+        print(f"写入AI文字缓存失败（不影响使用）: {e}")
+
+
+def track_cache_write(cache_dir, max_bytes, written_bytes):
+    """
+    记录一次缓存写入。进程内维护缓存总大小的估算值，只有估算值超出上限、或者距上次扫描已写入
+    CACHE_RESCAN_WRITES 次时，才扫描整个目录并淘汰，每次写入的平均开销与缓存文件数量无关。
+    覆盖已有文件时估算值会偏大，最多只是让下一次扫描提前。
+    """
+    with _cache_size_lock:
+        state = _cache_sizes.get(cache_dir)
+        if state is not None and state[1] < CACHE_RESCAN_WRITES and state[0] + written_bytes <= max_bytes:
+            state[0] += written_bytes
+            state[1] += 1
+            return
+    total_size = evict_cache(cache_dir, max_bytes, int(max_bytes * CACHE_EVICT_TARGET))
+    with _cache_size_lock:
+        _cache_sizes[cache_dir] = [total_size, 0]
+
+
+def evict_cache(cache_dir, max_bytes, target_bytes=None):
+    """
+    缓存总大小超过 max_bytes 时，删除最久未使用的缓存文件，直到不超过 target_bytes（默认等于 max_bytes）。
+    返回淘汰后的缓存总大小。
+    """
+    target_bytes = max_bytes if target_bytes is None else target_bytes
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    if total_size <= max_bytes:
+        return total_size
+    for _, size, path in sorted(entries):
+        if total_size <= target_bytes:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass  # 其他进程可能已经删除了这个文件
+    return total_size
+
+
+def prepare_ai_request(image, content_style, num_photos, frames=None, use_cache=True):
+    """
+    【请求准备】编码图片、生成提示词并计算缓存键，返回可以直接发送的请求字典:
+    messages（消息负载）和 cache_key（不使用缓存时为 None）。
+    请求字典只包含字符串，可以在进程之间传递，也可以交给 get_ai_texts_batch 并发发送。
+    """
+    separate_images = bool(frames) and len(frames) > 1
+    payload = build_image_payload(image, frames=frames if separate_images else None)
+    prompt = generate_prompt(content_style, num_photos, separate_images=separate_images)
+
+    cache_key = None
+    if use_cache and get_settings().cache_enabled:
+        cache_key = get_cache_key(payload["images"], content_style, num_photos, VISION_MODEL_NAME, prompt)
+
+    content = [{"type": "text", "text": prompt}]
+    for image_bytes in payload["images"]:
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+        })
+    return {"messages": [{"role": "user", "content": content}], "cache_key": cache_key,
+            "payload_bytes": payload["encoded_bytes"]}
+
+
+# 出错时返回给调用方的提示文字都以这些前缀开头，这类结果不应该被任何缓存保存
+FAILURE_PREFIXES = ("AI调用失败", "AI未能生成文本", "AI返回了未知格式")
+
+
+def is_failed_result(texts):
+    """判断 get_ai_text 返回的文字列表是否是出错时的提示文字"""
+    return any(isinstance(text, str) and text.startswith(FAILURE_PREFIXES) for text in texts)
+
+
+def parse_ai_result(raw_result_text):
+    """
+    解析AI返回的文字，返回 (文字列表, 是否可以缓存)。
+    对空回复、非JSON回复等异常情况做容错处理。
+    """
+    raw_result_text = (raw_result_text or "").strip()
+    print(f"AI原始返回结果: '{raw_result_text}'")
+
+    if not raw_result_text:
+        print("AI返回了空内容。")
+        return ["AI未能生成文本"], False
+
     try:
-        buffered = io.BytesIO()
-        image.convert("RGB").save(buffered, format="JPEG")
-        base64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        prompt = generate_prompt(content_style, num_photos)
-
-        # --- 2. 【核心修正】替换成您的服务商提供的、支持视觉功能的模型名称 ---
-        # 警告：您示例中的 "Qwen/Qwen2.5-72B-Instruct" 很可能不支持视觉。
-        # 您需要查找服务商文档，找到类似 Qwen-VL, Yi-VL, LLaVA 等多模态模型。
-        # 我在这里先使用一个常见的开源视觉模型名称作为示例，您需要替换成您可用的模型。
-        vision_model_name = "stepfun-ai/step3"  # <--- 请在这里填入您服务商提供的【正确视觉模型】名称！
-
-        print(f"正在使用模型 '{vision_model_name}' 向AI发送请求...")
-
-        messages_payload = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                    }
-                ]
-            }
-        ]
-
-        response = client.chat.completions.create(
-            model=vision_model_name,  # 使用正确的模型变量
-            messages=messages_payload,
+        data = json.loads(raw_result_text)
+        if "texts" not in data:
+            return [f"AI返回了未知格式: {raw_result_text}"], False
+        return data["texts"], True
+    except json.JSONDecodeError:
+        print("AI未返回标准JSON，已按普通文本处理。")
+        return [raw_result_text], True
+
+
+def get_ai_text(image: Image.Image, content_style: str, num_photos: int, use_cache: bool = True, frames=None):
+    """
+    把图片发送给视觉模型生成文字，返回文字列表。
+    use_cache 为 True（且没有设置环境变量 AI_CACHE_DISABLED）时，相同的请求直接返回磁盘缓存中的结果。
+    frames 为各帧照片的列表时，逐张单独发送，而不是发送整张拼接图。
+    """
+    with tracing.span("ai_request", model=VISION_MODEL_NAME, content_style=content_style) as request_span:
+        return _get_ai_text(image, content_style, num_photos, use_cache, frames, request_span)
+
+
+def _get_ai_text(image, content_style, num_photos, use_cache, frames, request_span):
+    try:
+        request = prepare_ai_request(image, content_style, num_photos, frames=frames, use_cache=use_cache)
+        request_span.set(payload_bytes=request["payload_bytes"])
+        cache_key = request["cache_key"]
+        if cache_key:
+            cached_texts = read_cached_texts(cache_key)
+            if cached_texts is not None:
+                print("命中AI文字缓存，跳过网络请求。")
+                request_span.set(cache_hit=True)
+                return cached_texts
+
+        print(f"正在使用模型 '{VISION_MODEL_NAME}' 向AI发送请求...")
+
+        response = get_client().chat.completions.create(
+            model=VISION_MODEL_NAME,  # 使用正确的模型变量
+            messages=request["messages"],
             max_tokens=200,
             # stream=False, # 我们暂时不使用流式传输，以简化代码
             # response_format={"type": "json_object"} # 您的服务商可能不支持此参数，我们先注释掉以提高兼容性
         )
 
-        raw_result_text = response.choices[0].message.content.strip()
-        print(f"AI原始返回结果: '{raw_result_text}'")
+        texts, cacheable = parse_ai_result(response.choices[0].message.content)
+        # 只缓存正常生成的文字，失败或格式异常的结果下次仍会重新请求
+        if cache_key and cacheable:
+            write_cached_texts(cache_key, texts)
+        return texts
 
-        if not raw_result_text:
-            print("AI返回了空内容。")
-            return ["AI未能生成文本"]
+    except Exception as e:
+        print(f"调用AI API时发生错误: {e}")
+        request_span.set(error=str(e))
+        return [f"AI调用失败: {e}"]
+
+
+# ===================================================================
+# 【异步并发版】批量生成时同时发出多个请求，带并发上限、令牌桶限速、指数退避重试和单次请求超时。
+
+class TokenBucket:
+    """令牌桶限速器：平均每秒发放 rate 个令牌，最多积攒 capacity 个，允许短时间的突发请求"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """取走一个令牌，令牌不足时等待"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def is_retryable_error(error):
+    """网络错误、超时、限流和服务端错误值得重试；参数错误等客户端错误重试也没有用"""
+    import openai
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
 
+
+async def _send_request_async(async_client, request, limiter, semaphore, timeout, max_retries, retry_base_delay):
+    cache_key = request["cache_key"]
+    for attempt in range(max_retries + 1):
         try:
-            data = json.loads(raw_result_text)
-            return data.get("texts", [f"AI返回了未知格式: {raw_result_text}"])
-        except json.JSONDecodeError:
-            print("AI未返回标准JSON，已按普通文本处理。")
-            return [raw_result_text]
+            async with semaphore:
+                await limiter.acquire()
+                response = await asyncio.wait_for(
+                    async_client.chat.completions.create(
+                        model=VISION_MODEL_NAME,
+                        messages=request["messages"],
+                        max_tokens=200,
+                    ),
+                    timeout=timeout,
+                )
+            texts, cacheable = parse_ai_result(response.choices[0].message.content)
+            if cache_key and cacheable:
+                write_cached_texts(cache_key, texts)
+            return texts
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                print(f"调用AI API时发生错误: {e}")
+                return [f"AI调用失败: {e}"]
+            # 指数退避，并加上随机抖动，避免所有失败的请求同时重试
+            delay = retry_base_delay * (2 ** attempt) * (0.5 + random.random())
+            print(f"AI请求失败（第 {attempt + 1} 次），{delay:.1f} 秒后重试: {e}")
+            await asyncio.sleep(delay)
 
-    except Exception as e:
-        print(f"调用AI API时发生错误: {e}")
-        return [f"AI调用失败: {e}"]
\ No newline at end of file
+
+async def get_ai_texts_batch(requests, concurrency=None, rate_limit=None, timeout=None, max_retries=None,
+                             retry_base_delay=1.0, async_client=None):
+    """
+    并发发送一批由 prepare_ai_request 准备好的请求，按原顺序返回每个请求的文字列表。
+    concurrency 为同时进行的请求数上限，rate_limit 为每秒最多发起的请求数，
+    timeout 为单次请求的超时秒数，max_retries 为可重试错误的最大重试次数。
+    以上参数为 None 时使用 .env 中的配置。
+    所有请求共用一个 AsyncOpenAI 客户端及其连接池；也可以传入 async_client（例如指向本地测试服务器）。
+    命中磁盘缓存的请求直接返回，全部命中时不创建客户端；没有配置 API 时，未命中的请求得到“AI调用失败”的提示文字，
+    与 get_ai_text 一样不抛出异常。
+    """
+    settings = get_settings()
+    concurrency = concurrency or settings.concurrency
+    rate_limit = rate_limit or settings.rate_limit
+    timeout = timeout or settings.request_timeout
+    max_retries = settings.max_retries if max_retries is None else max_retries
+
+    # 1. 先取出磁盘缓存中已有的结果，只有未命中的请求才需要发送
+    results = [None] * len(requests)
+    pending = []
+    for i, request in enumerate(requests):
+        if request["cache_key"]:
+            results[i] = read_cached_texts(request["cache_key"])
+        if results[i] is None:
+            pending.append(i)
+    if not pending:
+        return results
+    print(f"AI文字缓存命中 {len(requests) - len(pending)} 个，需要请求 {len(pending)} 个。")
+
+    # 2. 有未命中的请求时才创建客户端
+    owns_client = async_client is None
+    if owns_client:
+        try:
+            import openai
+            api_key, base_url = get_credentials()
+        except (ImportError, ValueError) as e:
+            print(f"调用AI API时发生错误: {e}")
+            for i in pending:
+                results[i] = [f"AI调用失败: {e}"]
+            return results
+        # 重试由我们自己控制，关闭SDK内置的重试
+        async_client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = TokenBucket(rate_limit)
+    try:
+        sent = await asyncio.gather(*(
+            _send_request_async(async_client, requests[i], limiter, semaphore, timeout, max_retries, retry_base_delay)
+            for i in pending
+        ))
+    finally:
+        if owns_client:
+            await async_client.close()
+    for i, texts in zip(pending, sent):
+        results[i] = texts
+    return results
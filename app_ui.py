@@ -1,11 +1,17 @@
 # file: app_ui.py (终极交互版)
 
 import customtkinter as ctk
-from tkinter import filedialog, StringVar
+from tkinter import filedialog, StringVar, BooleanVar
 from PIL import Image, ImageTk  # 添加ImageTk模块
-import layouts
 import ai_connector
-import threading
+import exporter
+import font_registry
+import lut_engine
+import pipeline
+import queue
+import tracing
+from render_executor import RenderExecutor
+import math
 import os  # 添加os模块用于读取目录内容
 from datetime import datetime  # 添加datetime模块用于生成文件名
 
@@ -13,7 +19,12 @@ from datetime import datetime  # 添加datetime模块用于生成文件名
 # ===================================================================
 # 【新】创建一个专门用于图片交互的画布控件类
 class ImageCanvas(ctk.CTkFrame):
-    def __init__(self, master):
+    PYRAMID_MIN_SIZE = 256   # 金字塔最小一层的长边不小于这个尺寸
+    RENDER_MARGIN = 0.5      # 在可见区域四周额外渲染的余量（相对画布尺寸），拖动时不用立刻重绘
+    REFINE_DELAY_MS = 150    # 输入停止多久之后做一次高质量重绘
+    RESIZE_SETTLE_MS = 400   # 尺寸停止变化多久之后算作调整结束，通知 on_resize_settled
+
+    def __init__(self, master, on_resize_settled=None):
         super().__init__(master)
 
         # 创建画布控件
@@ -22,7 +33,15 @@ class ImageCanvas(ctk.CTkFrame):
 
         # 初始化状态变量
         self.original_image = None  # 存储原始的、未经缩放的Pillow图片
-        self.display_image = None  # 存储当前显示在画布上的CTkImage对象
+        self.pyramid = []  # 原图的多级缩小版本（第0层就是原图），每层长宽减半
+        self.display_image = None  # 存储当前显示在画布上的PhotoImage对象
+        self.image_item = None  # 画布上图片元素的ID
+        self.rendered_box = None  # 已渲染部分在画布上的范围 (x0, y0, x1, y1)
+        self.refine_job = None  # 等待执行的高质量重绘任务
+        self.resize_job = None  # 等待执行的尺寸自适应任务（同一轮事件中的多次尺寸变化只处理一次）
+        self.settle_job = None  # 等待执行的“尺寸调整结束”通知
+        self.on_resize_settled = on_resize_settled  # 可选的回调函数，画布尺寸稳定下来后以新尺寸调用
+        self.canvas_size = None  # 上一次处理过的画布尺寸
         self.scale = 1.0  # 当前的缩放比例
         self.image_x = 0  # 图片在画布上的X坐标
         self.image_y = 0  # 图片在画布上的Y坐标
@@ -31,26 +50,33 @@ class ImageCanvas(ctk.CTkFrame):
         self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)  # 滚轮缩放
         self.canvas.bind("<ButtonPress-1>", self.on_button_press)  # 左键按下
         self.canvas.bind("<B1-Motion>", self.on_drag)  # 左键拖动
+        self.canvas.bind("<Configure>", self.on_canvas_configure)  # 画布尺寸变化
 
     def show_image(self, pillow_image):
         """外部调用此方法来载入一张新图片"""
         self.original_image = pillow_image
+        self.pyramid = self._build_pyramid(pillow_image)
         self.fit_image_to_canvas()
 
-    def fit_image_to_canvas(self):
+    def _build_pyramid(self, image):
+        """预先生成逐级减半的缩小图，缩小显示时从最接近的一层取图，而不是每次都缩放整张原图"""
+        levels = [image]
+        while max(levels[-1].size) >= self.PYRAMID_MIN_SIZE * 2:
+            levels.append(levels[-1].reduce(2))
+        return levels
+
+    def fit_image_to_canvas(self, high_quality=True):
         """【修正版】计算最佳缩放比例，让图片完整地显示在画布中央"""
         if not self.original_image:
             return
 
         # 【核心修正】在获取尺寸前，强制UI更新布局信息，确保获取到的是真实尺寸
         self.canvas.update_idletasks()
+        self._fit_to_size(self.canvas.winfo_width(), self.canvas.winfo_height())
+        self._redraw_image(high_quality=high_quality)
 
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
-
-        # 【删除】我们不再需要延时重试的逻辑了
-
-        # ...后续的缩放和居中逻辑保持不变...
+    def _fit_to_size(self, canvas_width, canvas_height):
+        """根据画布尺寸计算缩放比例和居中位置"""
         img_ratio = self.original_image.width / self.original_image.height
         canvas_ratio = canvas_width / canvas_height
 
@@ -62,26 +88,131 @@ class ImageCanvas(ctk.CTkFrame):
         self.image_x = (canvas_width - self.original_image.width * self.scale) / 2
         self.image_y = (canvas_height - self.original_image.height * self.scale) / 2
 
-        self._redraw_image()
-
-    def _redraw_image(self):
-        """核心重绘函数：根据当前缩放和位置，在画布上重新绘制图片"""
+    def on_canvas_configure(self, event):
+        """
+        【合并后的尺寸自适应】画布尺寸真正变化时才重新适配。
+        拖动窗口边缘时会连续触发大量事件，同一轮事件循环中只处理最后一次，并且只做快速缩放；
+        停止拖动后由 _redraw_image 安排的延迟重绘完成一次高质量渲染。
+        """
+        size = (event.width, event.height)
+        if size == self.canvas_size:
+            return
+        self.canvas_size = size
+        if self.original_image and self.resize_job is None:
+            self.resize_job = self.after_idle(self._apply_resize)
+
+    def _apply_resize(self):
+        self.resize_job = None
+        canvas_width, canvas_height = self.canvas_size
+        if canvas_width > 1 and canvas_height > 1:
+            self._fit_to_size(canvas_width, canvas_height)
+            self._redraw_image()
+            self._schedule_settle()
+
+    def _schedule_settle(self):
+        """拖动窗口边缘时不断推迟，尺寸停止变化 RESIZE_SETTLE_MS 毫秒后才通知一次"""
+        if self.on_resize_settled is None:
+            return
+        if self.settle_job is not None:
+            self.after_cancel(self.settle_job)
+        self.settle_job = self.after(self.RESIZE_SETTLE_MS, self._settle)
+
+    def _settle(self):
+        self.settle_job = None
+        self.on_resize_settled(self.canvas_size)
+
+    def _pick_pyramid_level(self):
+        """选择分辨率不低于当前显示比例的最小一层"""
+        level = self.pyramid[0]
+        for candidate in self.pyramid[1:]:
+            if candidate.width / self.original_image.width < self.scale:
+                break
+            level = candidate
+        return level
+
+    def _redraw_image(self, high_quality=False):
+        """
+        【视口渲染版】核心重绘函数：只渲染画布可见区域（加上少量余量）对应的那一块图片。
+        high_quality 为 False 时使用快速的双线性缩放，并在输入停止后自动补一次 LANCZOS 高质量重绘。
+        """
         if not self.original_image:
             return
+        with tracing.span("canvas_redraw", high_quality=high_quality):
+            self._render_viewport(high_quality)
 
-        # 清空画布
-        self.canvas.delete("all")
+        if high_quality:
+            self._cancel_refine()
+        else:
+            self._schedule_refine()
 
-        # 根据缩放比例计算新的宽高
-        new_width = int(self.original_image.width * self.scale)
-        new_height = int(self.original_image.height * self.scale)
+    def _render_viewport(self, high_quality):
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        margin_x = canvas_width * self.RENDER_MARGIN
+        margin_y = canvas_height * self.RENDER_MARGIN
+
+        # 1. 计算需要渲染的范围（画布坐标）：图片范围与“画布+余量”的交集
+        left = max(self.image_x, -margin_x)
+        top = max(self.image_y, -margin_y)
+        right = min(self.image_x + self.original_image.width * self.scale, canvas_width + margin_x)
+        bottom = min(self.image_y + self.original_image.height * self.scale, canvas_height + margin_y)
 
-        # 使用Pillow缩放图片
-        resized_img = self.original_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        self.canvas.delete("all")
+        self.image_item = None
+        self.rendered_box = None
+        if right - left < 1 or bottom - top < 1:
+            return  # 图片完全移出了画布
+
+        # 2. 从金字塔中选一层，把渲染范围换算成该层上的裁剪框
+        level = self._pick_pyramid_level()
+        ratio_x = level.width / self.original_image.width
+        ratio_y = level.height / self.original_image.height
+        crop_box = (
+            max(0, int((left - self.image_x) / self.scale * ratio_x)),
+            max(0, int((top - self.image_y) / self.scale * ratio_y)),
+            min(level.width, math.ceil((right - self.image_x) / self.scale * ratio_x)),
+            min(level.height, math.ceil((bottom - self.image_y) / self.scale * ratio_y)),
+        )
+
+        # 3. 只缩放裁剪出来的这一块，输出尺寸不会超过画布加余量
+        display_x = self.image_x + crop_box[0] / ratio_x * self.scale
+        display_y = self.image_y + crop_box[1] / ratio_y * self.scale
+        display_width = max(1, round((crop_box[2] - crop_box[0]) / ratio_x * self.scale))
+        display_height = max(1, round((crop_box[3] - crop_box[1]) / ratio_y * self.scale))
+        resample = Image.Resampling.LANCZOS if high_quality else Image.Resampling.BILINEAR
+        resized_img = level.crop(crop_box).resize((display_width, display_height), resample)
 
         # 转换为PhotoImage并放置在画布上
         self.display_image = ImageTk.PhotoImage(resized_img)
-        self.canvas.create_image(self.image_x, self.image_y, anchor="nw", image=self.display_image)
+        self.image_item = self.canvas.create_image(display_x, display_y, anchor="nw", image=self.display_image)
+        self.rendered_box = (display_x, display_y, display_x + display_width, display_y + display_height)
+
+    def _schedule_refine(self):
+        """输入停止 REFINE_DELAY_MS 毫秒后，按当前视口做一次高质量重绘"""
+        self._cancel_refine()
+        self.refine_job = self.after(self.REFINE_DELAY_MS, self._refine)
+
+    def _cancel_refine(self):
+        if self.refine_job is not None:
+            self.after_cancel(self.refine_job)
+            self.refine_job = None
+
+    def _refine(self):
+        self.refine_job = None
+        self._redraw_image(high_quality=True)
+
+    def _is_viewport_covered(self):
+        """判断画布上可见的那部分图片是否都已经渲染过"""
+        if self.rendered_box is None:
+            return False
+        visible_left = max(self.image_x, 0)
+        visible_top = max(self.image_y, 0)
+        visible_right = min(self.image_x + self.original_image.width * self.scale, self.canvas.winfo_width())
+        visible_bottom = min(self.image_y + self.original_image.height * self.scale, self.canvas.winfo_height())
+        if visible_right <= visible_left or visible_bottom <= visible_top:
+            return True  # 图片完全不可见，没有需要补画的地方
+        x0, y0, x1, y1 = self.rendered_box
+        return x0 <= visible_left + 1 and y0 <= visible_top + 1 and x1 >= visible_right - 1 and y1 >= visible_bottom - 1
 
     def on_mouse_wheel(self, event):
         """响应鼠标滚轮事件，进行缩放"""
@@ -98,7 +229,9 @@ class ImageCanvas(ctk.CTkFrame):
         self.drag_start_y = event.y
 
     def on_drag(self, event):
-        """响应鼠标拖动事件，移动图片"""
+        """响应鼠标拖动事件：只移动已有的画布元素，露出未渲染的区域时才重新裁剪"""
+        if not self.original_image:
+            return
         dx = event.x - self.drag_start_x
         dy = event.y - self.drag_start_y
 
@@ -109,34 +242,68 @@ class ImageCanvas(ctk.CTkFrame):
         self.drag_start_x = event.x
         self.drag_start_y = event.y
 
-        self._redraw_image()
+        if self.image_item is not None:
+            self.canvas.move(self.image_item, dx, dy)
+            x0, y0, x1, y1 = self.rendered_box
+            self.rendered_box = (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+
+        if self._is_viewport_covered():
+            self._schedule_refine()  # 停下来之后再按新的视口重新裁剪，补足四周的余量
+        else:
+            self._redraw_image()
 
 
 # ===================================================================
 
 class PhotoBoothApp(ctk.CTk):
+    RENDER_POLL_MS = 50  # 界面线程查看渲染事件队列的间隔
+    PROXY_REFRESH_RATIO = 1.25  # 画布变大后，新尺寸下的代理比例超过当前预览的这么多倍时重新渲染预览
+
     def __init__(self):
         super().__init__()
         self.style_choice_var = StringVar(value="保留间隙")
+        self.grade_at_source_var = BooleanVar(value=False)  # 是否在原图分辨率上调色（旧行为，速度较慢）
+        # 保存时除了所选文件之外，是否同时导出 JPEG / WebP 版本（与所选文件同名，扩展名不同）
+        self.also_export_vars = {"jpeg": BooleanVar(value=False), "webp": BooleanVar(value=False)}
+        self.webp_lossless_var = BooleanVar(value=False)  # WebP（所选文件或同时导出的版本）是否使用无损编码
+        # 各阶段结果的缓存：修改选项后重新渲染时，只重新计算受影响的阶段
+        self.stage_cache = pipeline.StageCache()
+        self.current_image_paths = None  # 最近一次选择的照片，修改选项时用它重新渲染
+        # 所有渲染都交给同一个后台执行器排队执行，进度和结果由 poll_render_events 在界面线程中取出
+        self.render_executor = RenderExecutor()
+        self.current_render = None  # 当前预览对应的照片和选项，保存时按它渲染全分辨率成品
+        self.current_texts = None  # 当前预览中绘制的文字，保存时复用，不再请求AI
+        self.current_preview_scale = 1.0  # 当前预览代理图相对成品的比例
         self.title("电影感照片生成器 V2.2 - 交互式预览")
         self.geometry("1200x800")
         self.resizable(True, True)
-        self.bind("<Configure>", self.on_resize)  # 窗口大小变化时也需要重绘
 
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=4)
         self.grid_rowconfigure(0, weight=1)
         self.setup_ui()
+        self.after(self.RENDER_POLL_MS, self.poll_render_events)
 
     def get_font_options(self):
-        """获取fonts目录下的所有字体文件"""
-        font_options = ["默认"]
-        if os.path.exists("fonts"):
-            for file in os.listdir("fonts"):
-                if file.endswith((".ttf", ".otf", ".ttc")):
-                    font_options.append(file)
+        """获取fonts目录下的所有字体文件（来自字体索引，只列出能正常解析的字体）"""
+        font_options = [font_registry.DEFAULT_FONT_NAME]
+        for face in font_registry.get_font_index():
+            if face.file_name not in font_options:
+                font_options.append(face.file_name)
         return font_options
 
+    def refresh_font_options(self):
+        """
+        重新读取字体索引并更新字体菜单，当前选择的字体已被删除时换回默认字体。
+        然后重新渲染：文字阶段的缓存键包含字体文件的修改时间，被替换的字体会重新绘制，没变化时直接命中缓存
+        """
+        font_options = self.get_font_options()
+        self.font_option_menu.configure(values=font_options)
+        if self.font_option_menu.get() not in font_options:
+            self.font_option_menu.set(font_registry.DEFAULT_FONT_NAME)
+        self.on_settings_changed()
+        self.status_label.configure(text=f"字体列表已刷新，共 {len(font_options) - 1} 个字体", text_color="green")
+
     def get_filter_options(self):
         """获取luts目录下的所有滤镜文件"""
         filter_options = ["无"]
@@ -154,153 +321,335 @@ class PhotoBoothApp(ctk.CTk):
         # ... (左侧控制面板的UI控件创建和之前一样，此处省略) ...
         ctk.CTkLabel(master=control_frame, text="1. 开始创作").pack(pady=(20, 5), padx=20)
         self.process_button = ctk.CTkButton(master=control_frame, text="选择照片并生成",
-                                            command=self.start_generation_thread)
+                                            command=self.start_generation)
         self.process_button.pack(pady=5, padx=20)
         ctk.CTkLabel(master=control_frame, text="2. 选择排版风格").pack(pady=(20, 5), padx=20)
         layout_options = ["电影竖排", "单张海报"]
-        self.layout_option_menu = ctk.CTkOptionMenu(master=control_frame, values=layout_options)
+        self.layout_option_menu = ctk.CTkOptionMenu(master=control_frame, values=layout_options,
+                                                    command=self.on_settings_changed)
         self.layout_option_menu.pack(pady=5, padx=20, fill="x")
         style_frame = ctk.CTkFrame(master=control_frame)
         style_frame.pack(pady=10, padx=20, fill="x")
         ctk.CTkLabel(master=style_frame, text="竖排样式:").pack(side="left", padx=10)
-        ctk.CTkRadioButton(master=style_frame, text="保留间隙", variable=self.style_choice_var, value="保留间隙").pack(
+        ctk.CTkRadioButton(master=style_frame, text="保留间隙", variable=self.style_choice_var, value="保留间隙",
+                           command=self.on_settings_changed).pack(
             side="left", padx=5)
-        ctk.CTkRadioButton(master=style_frame, text="无缝拼接", variable=self.style_choice_var, value="无缝拼接").pack(
+        ctk.CTkRadioButton(master=style_frame, text="无缝拼接", variable=self.style_choice_var, value="无缝拼接",
+                           command=self.on_settings_changed).pack(
             side="left", padx=5)
         ctk.CTkLabel(master=control_frame, text="3. 选择电影滤镜").pack(pady=(20, 5), padx=20)
         # 使用动态加载的滤镜选项
         filter_options = self.get_filter_options()
-        self.filter_option_menu = ctk.CTkOptionMenu(master=control_frame, values=filter_options)
+        self.filter_option_menu = ctk.CTkOptionMenu(master=control_frame, values=filter_options,
+                                                    command=self.on_settings_changed)
         self.filter_option_menu.pack(pady=5, padx=20, fill="x")
+        # 滤镜强度：低于100%时按LUT配方（如 "ColdChrome@60"）把强度预先合成进查找表，仍然只处理一遍
+        strength_frame = ctk.CTkFrame(master=control_frame)
+        strength_frame.pack(pady=5, padx=20, fill="x")
+        self.filter_strength_label = ctk.CTkLabel(master=strength_frame, text="强度 100%", width=80)
+        self.filter_strength_label.pack(side="left", padx=10)
+        self.filter_strength_slider = ctk.CTkSlider(master=strength_frame, from_=0, to=100, number_of_steps=20,
+                                                    command=self.on_filter_strength_changed)
+        self.filter_strength_slider.set(100)
+        self.filter_strength_slider.pack(side="left", padx=5, fill="x", expand=True)
+        ctk.CTkCheckBox(master=control_frame, text="在原图分辨率上调色（较慢）",
+                        variable=self.grade_at_source_var, command=self.on_settings_changed).pack(pady=5, padx=20, anchor="w")
         ctk.CTkLabel(master=control_frame, text="4. 选择文字风格").pack(pady=(20, 5), padx=20)
         # 使用动态加载的字体选项
         font_options = self.get_font_options()
-        self.font_option_menu = ctk.CTkOptionMenu(master=control_frame, values=font_options)
-        self.font_option_menu.pack(pady=5, padx=20, fill="x")
+        font_frame = ctk.CTkFrame(master=control_frame, fg_color="transparent")
+        font_frame.pack(pady=5, padx=20, fill="x")
+        self.font_option_menu = ctk.CTkOptionMenu(master=font_frame, values=font_options,
+                                                  command=self.on_settings_changed)
+        self.font_option_menu.pack(side="left", fill="x", expand=True)
+        # 程序运行期间往 fonts 目录里添加或删除字体后，点这个按钮重新读取字体索引（只分析有变化的文件）
+        ctk.CTkButton(master=font_frame, text="刷新", width=50, command=self.refresh_font_options).pack(
+            side="left", padx=(5, 0))
         content_style_options = ["简体短句", "繁体诗歌", "英文散文"]
-        self.content_style_menu = ctk.CTkOptionMenu(master=control_frame, values=content_style_options)
+        self.content_style_menu = ctk.CTkOptionMenu(master=control_frame, values=content_style_options,
+                                                   command=self.on_settings_changed)
         self.content_style_menu.pack(pady=10, padx=20, fill="x")
+        # 修改其他选项时沿用当前的文字；只有点这个按钮才会重新请求AI（不使用缓存）
+        ctk.CTkButton(master=control_frame, text="重新生成文字", command=self.regenerate_texts).pack(
+            pady=5, padx=20, fill="x")
         
+        # 导出设置：编码预设在编码耗时和文件大小之间取舍
+        ctk.CTkLabel(master=control_frame, text="5. 导出设置").pack(pady=(20, 5), padx=20)
+        self.export_preset_menu = ctk.CTkOptionMenu(master=control_frame, values=list(exporter.EXPORT_PRESETS))
+        self.export_preset_menu.set(exporter.DEFAULT_PRESET)
+        self.export_preset_menu.pack(pady=5, padx=20, fill="x")
+        also_export_frame = ctk.CTkFrame(master=control_frame)
+        also_export_frame.pack(pady=5, padx=20, fill="x")
+        ctk.CTkLabel(master=also_export_frame, text="同时导出:").pack(side="left", padx=10)
+        ctk.CTkCheckBox(master=also_export_frame, text="JPEG", variable=self.also_export_vars["jpeg"]).pack(
+            side="left", padx=5)
+        ctk.CTkCheckBox(master=also_export_frame, text="WebP", variable=self.also_export_vars["webp"]).pack(
+            side="left", padx=5)
+        ctk.CTkCheckBox(master=control_frame, text="WebP 使用无损编码（文件较大）",
+                        variable=self.webp_lossless_var).pack(pady=5, padx=20, anchor="w")
+
         # 添加保存图片按钮
         self.save_button = ctk.CTkButton(master=control_frame, text="保存图片", 
                                         command=self.save_image, state="disabled")
         self.save_button.pack(pady=10, padx=20, fill="x")
         
-        self.status_label = ctk.CTkLabel(master=control_frame, text="一切就绪，请开始创作")
+        self.status_label = ctk.CTkLabel(master=control_frame, text="一切就绪，请开始创作", wraplength=240)
         self.status_label.pack(pady=20, padx=20)
 
         # 【核心修改】用我们新的ImageCanvas替换掉旧的Frame和Label
-        self.image_canvas = ImageCanvas(self)
+        self.image_canvas = ImageCanvas(self, on_resize_settled=self.on_canvas_resized)
         self.image_canvas.grid(row=0, column=1, padx=20, pady=20, sticky="nsew")
-        
-    def on_resize(self, event):
-        """当整个App窗口大小改变时，让图片自适应"""
-        # 调用我们自定义控件的自适应方法
-        self.image_canvas.fit_image_to_canvas()
-
-    def on_resize(self, event):
-        """当整个App窗口大小改变时，让图片自适应"""
-        # 调用我们自定义控件的自适应方法
-        self.image_canvas.fit_image_to_canvas()
-
-    # # ... (start_generation_thread, generation_logic, select_files_and_proceed 等函数保持不变) ...
-    def start_generation_thread(self):
-        self.process_button.configure(state="disabled", text="生成中...")
-        thread = threading.Thread(target=self.generation_logic)
-        thread.daemon = True
-        thread.start()
-
-    def generation_logic(self):
-        selected_layout = self.layout_option_menu.get()
-        selected_style = self.style_choice_var.get()
-        selected_filter = self.filter_option_menu.get()
-        selected_font = self.font_option_menu.get()
-        selected_content_style = self.content_style_menu.get()
-        num_images_needed = 3 if selected_layout == "电影竖排" else 1
-        self.after(0, lambda: self.select_files_and_proceed(num_images_needed, selected_layout, selected_style,
-                                                            selected_filter, selected_font, selected_content_style))
-
-    def select_files_and_proceed(self, num_images, *args):
-        image_paths = filedialog.askopenfilenames(title=f"请选择 {num_images} 张照片",
-                                                  filetypes=[("Image Files", "*.jpg *.jpeg *.png")])
-        if len(image_paths) != num_images:
-            self.status_label.configure(text=f"错误: 需要 {num_images} 张图片!", text_color="red")
-            self.process_button.configure(state="normal", text="选择照片并生成")
+        # 窗口大小变化时，画布自己的 <Configure> 事件会让图片自适应（见 ImageCanvas.on_canvas_configure）；
+        # 调整结束后画布明显变大时，再按新尺寸重新渲染预览（见 on_canvas_resized）
+
+    def start_generation(self):
+        """选择照片（文件对话框在界面线程中打开），然后把渲染交给渲染执行器"""
+        self.select_files_and_proceed(*self.get_current_settings())
+
+    def get_current_settings(self):
+        """读取当前界面上的所有选项，顺序与 process_after_selection 的参数一致"""
+        return (self.layout_option_menu.get(), self.style_choice_var.get(), self.get_filter_recipe(),
+                self.font_option_menu.get(), self.content_style_menu.get(), self.grade_at_source_var.get())
+
+    def get_filter_recipe(self):
+        """所选滤镜连同强度组成LUT配方，强度为100%时就是滤镜名称本身"""
+        filter_name = self.filter_option_menu.get()
+        if filter_name == "无":
+            return filter_name
+        strength = round(self.filter_strength_slider.get())
+        return lut_engine.format_recipe([(filter_name, strength / 100)])
+
+    def on_filter_strength_changed(self, value):
+        """
+        拖动强度滑块时，每一步都提交一次预览；新的预览会取消还没完成的旧预览，不会堆积。
+        预览使用 lut_engine.PREVIEW_BACKEND，每一步只合成一张小表，不烘焙 256^3 的查找表
+        """
+        self.filter_strength_label.configure(text=f"强度 {round(value)}%")
+        self.on_settings_changed()
+
+    def on_settings_changed(self, *_):
+        """
+        选项变化时用最近选择的照片重新渲染；前面没有变化的阶段会直接命中缓存。
+        连续快速修改时，每次提交都会取消上一次还没完成的预览渲染，不会堆积多次完整渲染。
+        """
+        if not self.current_image_paths:
             return
-        thread = threading.Thread(target=self.process_after_selection, args=(image_paths, *args))
-        thread.daemon = True
-        thread.start()
-
-    def process_after_selection(self, image_paths, selected_layout, selected_style, selected_filter, selected_font,
-                                selected_content_style):
-        try:
-            self.status_label.configure(text="图片处理中...")
-            images = [Image.open(p) for p in image_paths]
-
-            # 【核心修正】调整操作顺序：先应用滤镜
-            self.status_label.configure(text="滤镜应用中...")
-            # 1. 先对原始图片应用滤镜
-            filtered_images = [layouts.apply_filter(img, selected_filter) for img in images]
-
-            # 将用户的布局选择打包，方便传递
-            layout_params = {'style': selected_style}
-
-            self.status_label.configure(text="正在生成布局...")
-            # 2. 然后用处理过的图片去创建布局
-            if selected_layout == "电影竖排":
-                composed_image = layouts.create_film_strip_layout(filtered_images, style=selected_style)
-            else:  # 单张海报
-                composed_image = layouts.create_poster_layout(filtered_images)
-
-            self.status_label.configure(text="正在请求AI生成文字...")
-            # 3. 把带边框但不带文字的图发给AI
-            ai_texts = ai_connector.get_ai_text(composed_image, selected_content_style, len(images))
-
-            self.status_label.configure(text="正在绘制文字...")
-            # 4. 最后在图上绘制文字
-            self.final_image_with_text = layouts.draw_text_on_image(
-                image=composed_image,
-                texts=ai_texts,
-                layout_style=selected_layout,
-                font_name=selected_font,
-                original_images=images,  # 仍然传入最原始的图片用于尺寸计算
-                layout_params=layout_params
-            )
+        settings = self.get_current_settings()
+        if settings[0] == "电影竖排":
+            image_paths = self.current_image_paths  # 电影竖排使用全部照片，张数不限
+        else:  # 单张海报只用第一张
+            image_paths = self.current_image_paths[:1]
+        self.submit_preview(image_paths, settings, texts=self.get_reusable_texts(image_paths, settings))
+
+    def on_canvas_resized(self, view_size):
+        """
+        画布尺寸稳定下来后调用：代理图是按提交时的画布尺寸渲染的，画布变大后只能放大显示，画面会发虚。
+        新尺寸下的代理比例明显更大时，按新尺寸重新提交预览；解码和滤镜按新比例重新计算，文字沿用当前预览。
+        """
+        if self.current_render is None or self.current_preview_scale >= 1:
+            return
+        render_args = self.current_render
+        scale = pipeline.get_proxy_scale(render_args["image_paths"], render_args["layout_style"],
+                                         render_args["style"], view_size)
+        if scale > self.current_preview_scale * self.PROXY_REFRESH_RATIO:
+            self.on_settings_changed()
+
+    def get_reusable_texts(self, image_paths, settings):
+        """
+        照片和内容风格都没变时，沿用当前预览中的文字，不再请求AI（即使阶段缓存中的文字已被淘汰）；
+        AI请求失败时的占位文字不沿用。
+        """
+        if self.current_render is None or self.current_texts is None:
+            return None
+        if ai_connector.is_failed_result(self.current_texts):
+            return None
+        if (self.current_render["image_paths"] != image_paths
+                or self.current_render["content_style"] != settings[4]):
+            return None
+        return self.current_texts
+
+    def regenerate_texts(self):
+        """用户明确要求新的文字：跳过阶段缓存和磁盘缓存，重新请求AI"""
+        if not self.current_render:
+            return
+        settings = self.get_current_settings()
+        self.submit_preview(self.current_render["image_paths"], settings, use_ai_cache=False)
 
-            self.after(0, self.update_status_and_display, self.final_image_with_text)
+    def select_files_and_proceed(self, selected_layout, *args):
+        # 电影竖排可以选择任意多张照片（按选择顺序从上到下排列），单张海报只需要一张
+        if selected_layout == "电影竖排":
+            title = "请选择照片（可多选）"
+        else:
+            title = "请选择 1 张照片"
+        image_paths = filedialog.askopenfilenames(title=title, filetypes=[("Image Files", "*.jpg *.jpeg *.png")])
+        if not image_paths or (selected_layout == "单张海报" and len(image_paths) != 1):
+            message = "错误: 请至少选择 1 张图片!" if not image_paths else "错误: 单张海报需要 1 张图片!"
+            self.status_label.configure(text=message, text_color="red")
+            return
+        self.current_image_paths = list(image_paths)
+        self.submit_preview(self.current_image_paths, (selected_layout, *args))
+
+    def submit_preview(self, image_paths, settings, texts=None, use_ai_cache=True):
+        """
+        把预览渲染提交给渲染执行器，取代还没完成的旧预览。
+        texts 不为 None 时直接绘制这些文字；use_ai_cache 为 False 时忽略缓存重新请求AI。
+        """
+        # 画布尺寸在界面线程中读取，后台任务不接触任何控件
+        view_size = self.image_canvas.canvas_size or (1, 1)
+        self.render_executor.submit(
+            lambda job: self.process_after_selection(job, view_size, image_paths, *settings, texts=texts,
+                                                     use_ai_cache=use_ai_cache), group="preview")
+        self.process_button.configure(text="生成中...")
+
+    def process_after_selection(self, job, view_size, image_paths, selected_layout, selected_style, selected_filter,
+                                selected_font, selected_content_style, grade_at_source=False, texts=None,
+                                use_ai_cache=True):
+        """在渲染执行器的后台线程中运行，返回 (预览图, 渲染参数, 文字, 各阶段耗时的汇总, 代理比例)"""
+        render_args = dict(
+            image_paths=image_paths,
+            layout_style=selected_layout,
+            style=selected_style,
+            filter_name=selected_filter,
+            font_name=selected_font,
+            content_style=selected_content_style,
+            grade_at_source=grade_at_source,
+        )
+        # 预览只按画布大小渲染代理图，大尺寸照片也能很快看到结果；全分辨率成品在保存时再渲染。
+        # 预览的滤镜用不需要烘焙查找表的后端，拖动强度滑块时每一步都能很快出图
+        scale = pipeline.get_proxy_scale(image_paths, selected_layout, selected_style, view_size)
+        texts_holder = []
+
+        # 解码、滤镜、布局、AI赋文和绘制文字都在 pipeline 中完成；进度经事件队列交给界面线程显示
+        with tracing.capture() as spans:
+            preview_image = pipeline.render_collage(
+                **render_args,
+                texts=texts,
+                use_ai_cache=use_ai_cache,
+                on_status=job.report,
+                cache=self.stage_cache,
+                scale=scale,
+                backend=lut_engine.PREVIEW_BACKEND,
+                on_texts=texts_holder.append,
+                should_cancel=job.is_cancelled
+            )
+        # 命中缓存的阶段没有计时记录，全部命中时汇总为空
+        timing = tracing.summarize(spans) or "全部命中缓存"
+        return preview_image, render_args, texts_holder[0] if texts_holder else None, timing, scale
+
+    def poll_render_events(self):
+        """界面线程中定时取出渲染执行器的事件：只有这里会根据后台任务的结果更新控件"""
+        while True:
+            try:
+                job, kind, payload = self.render_executor.events.get_nowait()
+            except queue.Empty:
+                break
+            if job.group == "preview":
+                self.handle_preview_event(job, kind, payload)
+            else:
+                self.handle_export_event(kind, payload)
+        self.after(self.RENDER_POLL_MS, self.poll_render_events)
+
+    def handle_preview_event(self, job, kind, payload):
+        if not self.render_executor.is_current(job):
+            return  # 已经被更新的预览取代，结果和进度都不再显示
+        if kind == "status":
+            self.status_label.configure(text=payload, text_color="green")
+            return
+        self.process_button.configure(text="选择照片并生成")
+        if kind == "done":
+            self.update_status_and_display(*payload)
+        elif kind == "error":
+            self.status_label.configure(text=f"发生未知错误: {payload}", text_color="red")
+
+    def handle_export_event(self, kind, payload):
+        if kind == "status":
+            self.status_label.configure(text=payload, text_color="green")
+        elif kind == "done":
+            # 全分辨率成品已经渲染好，编码和写文件在导出线程池中进行，这里定时查看是否完成
+            self.status_label.configure(text="正在编码并写入文件...", text_color="green")
+            self.watch_export(payload)
+        elif kind == "error":
+            self.show_export_error(payload)
+
+    def watch_export(self, futures):
+        """界面线程中定时查看导出任务，全部完成后显示结果"""
+        if not all(future.done() for future in futures):
+            self.after(self.RENDER_POLL_MS, self.watch_export, futures)
+            return
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            self.show_export_error(errors[0])
+            return
+        saved_paths = [future.result() for future in futures]
+        self.status_label.configure(text=f"图片已保存到: {', '.join(saved_paths)}", text_color="green")
+        self.save_button.configure(state="normal")
 
-        except Exception as e:
-            self.status_label.configure(text=f"发生未知错误: {e}", text_color="red")
-        finally:
-            self.process_button.configure(state="normal", text="选择照片并生成")
+    def show_export_error(self, error):
+        self.status_label.configure(text=f"保存图片时出错: {str(error)}", text_color="red")
+        self.save_button.configure(state="normal")
 
-    def update_status_and_display(self, final_image):
-        """更新状态，并让新的画布控件显示图片"""
-        self.status_label.configure(text="大功告成！请在右侧交互！", text_color="green")
-        self.image_canvas.show_image(final_image)
+    def update_status_and_display(self, preview_image, render_args, texts, timing, scale=1.0):
+        """更新状态（附带各阶段耗时），并让新的画布控件显示预览图"""
+        self.current_render = render_args
+        self.current_texts = texts
+        self.current_preview_scale = scale
+        self.status_label.configure(text=f"大功告成！请在右侧交互！\n{timing}", text_color="green")
+        self.image_canvas.show_image(preview_image)
         # 启用保存按钮
         self.save_button.configure(state="normal")
 
     def save_image(self):
-        """保存生成的图片到本地"""
-        if not hasattr(self, 'final_image_with_text'):
+        """
+        选择保存位置后，由渲染执行器渲染全分辨率成品，再交给导出线程池编码写入，界面保持可用。
+        勾选了“同时导出”的格式会与所选文件并行编码。
+        """
+        if self.current_render is None:
             self.status_label.configure(text="没有可保存的图片！", text_color="red")
             return
-            
-        try:
-            # 打开保存文件对话框
-            file_path = filedialog.asksaveasfilename(
-                defaultextension=".png",
-                filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg"), ("All files", "*.*")],
-                title="保存图片",
-                initialfile=f"photomagic_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            )
-            
-            # 如果用户选择了文件路径，则保存图片
-            if file_path:
-                self.final_image_with_text.save(file_path)
-                self.status_label.configure(text=f"图片已保存到: {file_path}", text_color="green")
-            else:
-                self.status_label.configure(text="保存操作已取消", text_color="green")
-        except Exception as e:
-            self.status_label.configure(text=f"保存图片时出错: {str(e)}", text_color="red")
\ No newline at end of file
+
+        # 打开保存文件对话框
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".png",
+            filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg"), ("WebP files", "*.webp"),
+                       ("All files", "*.*")],
+            title="保存图片",
+            initialfile=f"photomagic_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        )
+        if not file_path:
+            self.status_label.configure(text="保存操作已取消", text_color="green")
+            return
+
+        webp_lossless = self.webp_lossless_var.get()
+        outputs = [(file_path, exporter.format_from_path(file_path, webp_lossless))]
+        for format_key, var in self.also_export_vars.items():
+            if format_key == "webp" and webp_lossless:
+                format_key = "webp-lossless"
+            if var.get() and format_key != outputs[0][1]:
+                outputs.append((exporter.with_format_extension(file_path, format_key), format_key))
+        preset = self.export_preset_menu.get()
+
+        self.save_button.configure(state="disabled")
+        self.status_label.configure(text="正在渲染全分辨率图片...", text_color="green")
+        render_args, texts = self.current_render, self.current_texts
+        # 导出不会被之后的预览取代：修改选项不应该让已经开始的保存半途而废
+        self.render_executor.submit(
+            lambda job: self.export_full_resolution(job, outputs, preset, render_args, texts),
+            group="export", supersede=False)
+
+    def export_full_resolution(self, job, outputs, preset, render_args, texts):
+        """
+        在渲染执行器的后台线程中运行：用与预览相同的照片、选项和文字渲染全分辨率成品，
+        然后把编码交给导出线程池，返回 Future 列表，渲染执行器不必等待编码完成就能继续处理预览。
+        """
+        if (render_args["layout_style"] == "电影竖排" and not render_args["grade_at_source"]
+                and [format_key for _, format_key in outputs] == ["png"]):
+            # 长胶卷按帧分段写出，不需要把整张成品放进内存
+            file_path = outputs[0][0]
+            return [exporter.get_export_pool().submit(
+                pipeline.stream_film_strip, render_args["image_paths"], file_path, style=render_args["style"],
+                filter_name=render_args["filter_name"], font_name=render_args["font_name"], texts=texts,
+                on_status=job.report, compression_level=exporter.get_png_compress_level(preset))]
+
+        final_image = pipeline.render_collage(**render_args, texts=texts, use_ai=False,
+                                              cache=self.stage_cache, on_status=job.report)
+        return exporter.submit_export(final_image, outputs, preset)
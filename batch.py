@@ -0,0 +1,302 @@
+# file: batch.py
+"""
+无界面的批量生成工具，不依赖 customtkinter，可在服务器上定时运行。
+
+用法示例:
+    python batch.py photos/ -o output/ --layout 电影竖排 --filter ColdChrome
+    python batch.py jobs.json --ai --workers 8
+    python batch.py roll/ --frames 0            # 整个目录拼成一条长胶卷
+
+输入可以是一个图片目录（按文件名排序，电影竖排默认每3张一组，单张海报每张一组），
+也可以是一个 JSON 任务清单，格式为任务列表，每个任务可单独覆盖命令行中的默认选项:
+    [
+        {"images": ["a.jpg", "b.jpg", "c.jpg"], "output": "out/abc.png",
+         "layout": "电影竖排", "style": "无缝拼接", "filter": "ColdChrome", "backend": "pillow-native",
+         "font": "默认", "texts": ["第一句", "第二句", "第三句"]}
+    ]
+电影竖排输出为 PNG 且不需要请求AI时，按帧分段流式写出，内存占用与胶卷长度无关。
+输出格式按扩展名（.png / .jpg / .webp）判断，--webp-lossless 让 .webp 输出改用无损编码，
+--preset 选择编码预设（最快 / 均衡 / 最小），
+所有文件都先写入临时文件再改名，中断时不会留下写了一半的文件。
+任务数少于进程数时，多帧电影竖排的各帧分给所有进程并行处理，帧通过共享内存直接写入画布（见 shm_pool.py）。
+--trace 把每个任务各阶段的计时写入文件（.json 为 Chrome 跟踪格式，每个工作进程一个文件；其他扩展名为 JSON lines）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import util as multiprocessing_util
+
+import ai_connector
+import exporter
+import layouts
+import lut_engine
+import pipeline
+import shm_pool
+import tracing
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+LAYOUTS = ("电影竖排", "单张海报")
+DEFAULT_STRIP_FRAMES = 3  # 目录输入时电影竖排默认每组的照片数量
+SHARED_STRIP_MAX_FRAMES = 200  # 超过这个帧数的长胶卷仍按帧流式写出，内存占用不随胶卷长度增长
+CAPTION_CHUNK_JOBS = 64  # 需要AI的任务每批处理的数量，主进程中同时保留的不带文字布局图不超过这么多
+
+
+def get_worker_count():
+    """可用的CPU核心数（优先考虑进程的CPU亲和性设置）"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def jobs_from_directory(input_dir, output_dir, group_size):
+    """把目录中的图片按每组 group_size 张分组（0 表示全部放进一组），剩下凑不满一组的图片会被跳过"""
+    image_files = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    if group_size == 0:
+        group_size = max(1, len(image_files))
+
+    jobs = []
+    for i in range(0, len(image_files) - group_size + 1, group_size):
+        group = image_files[i:i + group_size]
+        output_name = f"{os.path.splitext(group[0])[0]}_collage.png"
+        jobs.append({
+            "images": [os.path.join(input_dir, f) for f in group],
+            "output": os.path.join(output_dir, output_name),
+        })
+
+    leftover = len(image_files) % group_size
+    if leftover:
+        print(f"警告：最后 {leftover} 张图片凑不满一组（每组 {group_size} 张），已跳过。")
+    return jobs
+
+
+def jobs_from_manifest(manifest_path, output_dir):
+    """读取 JSON 任务清单；清单中的相对路径以清单文件所在目录为准"""
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        jobs = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for i, job in enumerate(jobs):
+        job["images"] = [os.path.join(base_dir, p) for p in job["images"]]
+        if "output" in job:
+            job["output"] = os.path.join(base_dir, job["output"])
+        else:
+            job["output"] = os.path.join(output_dir, f"collage_{i:05d}.png")
+    return jobs
+
+
+def init_worker_tracing(trace_path):
+    """
+    工作进程的初始化函数：启用计时输出。工作进程退出时不会执行 atexit，
+    所以另外登记一个 multiprocessing 的退出回调来补全跟踪文件。
+    """
+    tracing.enable(trace_path, per_process=True)
+    multiprocessing_util.Finalize(None, tracing.disable, exitpriority=10)
+
+
+def get_job_format(job):
+    """任务输出文件的格式：按扩展名判断，"webp_lossless" 为 True 时 .webp 按无损编码"""
+    return exporter.format_from_path(job["output"], webp_lossless=job["webp_lossless"])
+
+
+def render_job(job):
+    """在工作进程中渲染一个任务并写出结果，返回输出路径"""
+    os.makedirs(os.path.dirname(os.path.abspath(job["output"])), exist_ok=True)
+    if can_stream(job):
+        return pipeline.stream_film_strip(job["images"], job["output"], style=job["style"], filter_name=job["filter"],
+                                          font_name=job["font"], texts=job.get("texts"),
+                                          compression_level=exporter.get_png_compress_level(job["preset"]),
+                                          backend=job["backend"])
+
+    final_image = pipeline.render_collage(
+        job["images"],
+        layout_style=job["layout"],
+        style=job["style"],
+        filter_name=job["filter"],
+        font_name=job["font"],
+        content_style=job["content_style"],
+        texts=job.get("texts"),
+        use_ai=job["use_ai"],
+        use_ai_cache=job["use_ai_cache"],
+        ai_separate_frames=job["ai_separate_frames"],
+        backend=job["backend"],
+    )
+    return exporter.save_image(final_image, job["output"], get_job_format(job), preset=job["preset"])
+
+
+def can_stream(job):
+    """电影竖排写 PNG 且文字已经确定（或不需要文字）时，可以分段流式写出"""
+    return (job["layout"] == "电影竖排" and get_job_format(job) == "png"
+            and (job.get("texts") is not None or not job["use_ai"]))
+
+
+def render_job_shared(job, executor):
+    """在主进程中把一条电影竖排的各帧分给进程池并行处理，帧直接写入共享内存中的画布，返回输出路径"""
+    os.makedirs(os.path.dirname(os.path.abspath(job["output"])), exist_ok=True)
+    final_image = shm_pool.render_film_strip(executor, job["images"], style=job["style"], filter_name=job["filter"],
+                                             font_name=job["font"], texts=job.get("texts"), backend=job["backend"])
+    return exporter.save_image(final_image, job["output"], get_job_format(job), preset=job["preset"])
+
+
+def can_share_frames(job, job_count, workers):
+    """
+    任务数少于进程数时，单个任务独占一个进程会让其余核心闲着：
+    这时把多帧电影竖排的各帧分给所有进程并行处理（文字需要已经确定，或者不需要文字）。
+    """
+    return (job_count < workers and job["layout"] == "电影竖排"
+            and 1 < len(job["images"]) <= SHARED_STRIP_MAX_FRAMES
+            and (job.get("texts") is not None or not job["use_ai"]))
+
+
+def prepare_caption_request(job):
+    """
+    在工作进程中拼好不带文字的布局图，并准备好发送给AI的请求（请求只包含字符串）。
+    布局图和布局几何一并返回，拿到文字后直接在它上面绘制，不必再解码、调色、排版一遍。
+    """
+    _, filtered_images, composed_image, geometry = pipeline.compose_collage(
+        job["images"],
+        layout_style=job["layout"],
+        style=job["style"],
+        filter_name=job["filter"],
+        backend=job["backend"],
+    )
+    frames = filtered_images if job["ai_separate_frames"] else None
+    # 单张海报只用第一张照片，文字条数按布局中的帧数计算，与 pipeline.render_collage 一致
+    request = ai_connector.prepare_ai_request(composed_image, job["content_style"], len(geometry.frames),
+                                              frames=frames, use_cache=job["use_ai_cache"])
+    return request, composed_image, geometry
+
+
+def finish_captioned_job(job, composed_image, geometry, texts):
+    """在工作进程中把AI文字画到已经拼好的布局图上并写出结果，返回输出路径"""
+    os.makedirs(os.path.dirname(os.path.abspath(job["output"])), exist_ok=True)
+    final_image = layouts.draw_text_on_image(composed_image, texts, geometry, job["font"])
+    return exporter.save_image(final_image, job["output"], get_job_format(job), preset=job["preset"])
+
+
+def needs_caption(job):
+    """需要AI、又没有给定文字的任务"""
+    return job["use_ai"] and job.get("texts") is None
+
+
+def caption_jobs(jobs, executor, concurrency):
+    """
+    渲染需要AI文字的任务：每 CAPTION_CHUNK_JOBS 个任务一批，先在进程池中拼好布局图、准备请求，
+    再在主进程中用异步客户端并发发送，拿到文字后把布局图交回进程池绘制文字并写出。
+    每个任务的解码、调色、排版只做一次；主进程中同时保留的布局图不超过一批。
+    返回 {Future: 任务}，Future 的结果为输出路径。
+    """
+    futures = {}
+    for start in range(0, len(jobs), CAPTION_CHUNK_JOBS):
+        chunk = jobs[start:start + CAPTION_CHUNK_JOBS]
+        print(f"正在为第 {start + 1}-{start + len(chunk)} 个需要AI的任务准备请求...")
+        prepare_futures = [executor.submit(prepare_caption_request, job) for job in chunk]
+        prepared = []
+        for job, future in zip(chunk, prepare_futures):
+            try:
+                prepared.append((job, *future.result()))
+            except Exception as e:
+                # 准备失败的任务按普通任务渲染，渲染阶段会再尝试一次并报告错误
+                print(f"准备AI请求失败: {job['images']} -> {e}")
+                futures[executor.submit(render_job, job)] = job
+
+        print(f"正在并发请求AI文字（并发数 {concurrency}）...")
+        requests = [request for _, request, _, _ in prepared]
+        results = asyncio.run(ai_connector.get_ai_texts_batch(requests, concurrency=concurrency))
+        for (job, _, composed_image, geometry), texts in zip(prepared, results):
+            job["texts"] = texts
+            futures[executor.submit(finish_captioned_job, job, composed_image, geometry, texts)] = job
+        del prepared  # 布局图已经交给进程池，主进程不再持有
+    return futures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="批量生成电影感拼图（无界面）")
+    parser.add_argument("input", help="图片目录，或 JSON 任务清单文件")
+    parser.add_argument("-o", "--output", default="output", help="输出目录（默认: output）")
+    parser.add_argument("--layout", default="电影竖排", choices=LAYOUTS, help="排版风格")
+    parser.add_argument("--frames", type=int, default=DEFAULT_STRIP_FRAMES,
+                        help="目录输入时电影竖排每条的照片数量，0 表示整个目录拼成一条（默认: 3）")
+    parser.add_argument("--style", default="保留间隙", choices=["保留间隙", "无缝拼接"], help="电影竖排的样式")
+    parser.add_argument("--filter", default="无",
+                        help="luts 目录中的滤镜名称（不含 .cube），也可以是LUT配方，如 \"ColdChrome@60\" 或 \"A>B@60\"")
+    parser.add_argument("--backend", default=lut_engine.DEFAULT_BACKEND, choices=lut_engine.FILTER_BACKENDS,
+                        help=f"滤镜后端（默认: {lut_engine.DEFAULT_BACKEND}）；pillow-native 释放GIL，colour 为浮点精度参照")
+    parser.add_argument("--font", default="默认", help="fonts 目录中的字体文件名")
+    parser.add_argument("--content-style", default="简体短句", choices=["简体短句", "繁体诗歌", "英文散文"],
+                        help="AI文字的内容风格")
+    parser.add_argument("--ai", action="store_true", help="为没有给定文字的任务请求AI生成文字（需要配置 .env）")
+    parser.add_argument("--no-ai-cache", action="store_true", help="不使用AI文字缓存，总是重新请求")
+    parser.add_argument("--ai-separate-frames", action="store_true",
+                        help="把电影竖排的每一帧单独发送给AI，而不是发送整张拼接图")
+    parser.add_argument("--ai-concurrency", type=int, default=None,
+                        help="同时进行的AI请求数（默认取 .env 中的 AI_CONCURRENCY，未设置时为4）")
+    parser.add_argument("--preset", default=exporter.DEFAULT_PRESET, choices=list(exporter.EXPORT_PRESETS),
+                        help=f"编码预设，在编码耗时和文件大小之间取舍（默认: {exporter.DEFAULT_PRESET}）")
+    parser.add_argument("--webp-lossless", action="store_true", help="输出为 .webp 的任务使用无损 WebP 编码")
+    parser.add_argument("--trace", default=os.getenv(tracing.TRACE_ENV_VAR),
+                        help=f"把各阶段的计时写入这个文件（默认取环境变量 {tracing.TRACE_ENV_VAR}）")
+    parser.add_argument("--workers", type=int, default=get_worker_count(), help="并行进程数（默认: 可用核心数）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # 1. 收集任务，并用命令行选项补全每个任务缺省的设置
+    if os.path.isdir(args.input):
+        group_size = args.frames if args.layout == "电影竖排" else 1
+        jobs = jobs_from_directory(args.input, args.output, group_size)
+    else:
+        jobs = jobs_from_manifest(args.input, args.output)
+
+    defaults = {"layout": args.layout, "style": args.style, "filter": args.filter, "backend": args.backend,
+                "font": args.font, "content_style": args.content_style, "use_ai": args.ai,
+                "use_ai_cache": not args.no_ai_cache, "ai_separate_frames": args.ai_separate_frames,
+                "preset": args.preset, "webp_lossless": args.webp_lossless}
+    jobs = [{**defaults, **job} for job in jobs]
+    if not jobs:
+        print("没有找到可处理的任务。")
+        return 0
+
+    # 2. 在进程池中并行渲染；需要AI文字时先统一并发请求，渲染阶段就不再逐个等待网络
+    print(f"共 {len(jobs)} 个任务，使用 {args.workers} 个进程...")
+    failed = 0
+    initializer, initargs = (init_worker_tracing, (args.trace,)) if args.trace else (None, ())
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=initializer, initargs=initargs) as executor:
+        # 清单中的任务也可以单独设置 "use_ai"；需要AI的任务拼好布局图后直接在上面绘制文字，不再完整渲染一遍
+        captioned_jobs = [job for job in jobs if needs_caption(job)]
+        other_jobs = [job for job in jobs if not needs_caption(job)]
+        futures = {}
+        if captioned_jobs:
+            futures.update(caption_jobs(captioned_jobs, executor,
+                                        args.ai_concurrency or ai_connector.get_settings().concurrency))
+
+        shared_jobs = [job for job in other_jobs if can_share_frames(job, len(jobs), args.workers)]
+        futures.update({executor.submit(render_job, job): job for job in other_jobs if job not in shared_jobs})
+        done = 0
+        for job in shared_jobs:
+            done += 1
+            try:
+                print(f"[{done}/{len(jobs)}] 已生成（多进程分帧）: {render_job_shared(job, executor)}")
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(jobs)}] 失败: {job['images']} -> {e}")
+
+        for future in as_completed(futures):
+            done += 1
+            job = futures[future]
+            try:
+                print(f"[{done}/{len(jobs)}] 已生成: {future.result()}")
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(jobs)}] 失败: {job['images']} -> {e}")
+
+    print(f"完成：成功 {len(jobs) - failed} 个，失败 {failed} 个。")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
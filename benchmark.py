@@ -0,0 +1,320 @@
+# file: benchmark.py
+"""
+渲染流程的基准测试：离线生成固定种子的合成照片，分别测量每个阶段的耗时、
+内存分配峰值（tracemalloc）和该阶段运行期间进程常驻内存（RSS）峰值的增长，结果写成 JSON，
+并可以与保存下来的基准结果比较，耗时或内存超出阈值的阶段视为性能退化。
+
+用法示例:
+    python benchmark.py -o bench.json                         # 运行并保存结果
+    python benchmark.py --baseline bench.json --threshold 0.15  # 与基准比较，退化时返回码为1
+    python benchmark.py --resolutions 2MP --backends numpy-baked colour --repeat 5
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw
+
+import font_registry
+import layouts
+import lut_engine
+
+# 合成照片的分辨率（宽, 高），都是常见相机的 3:2 画幅
+RESOLUTIONS = {
+    "2MP": (1800, 1200),
+    "12MP": (4248, 2832),
+    "24MP": (6000, 4000),
+}
+DEFAULT_RESOLUTIONS = ["2MP", "12MP"]
+DEFAULT_BACKENDS = ["numpy-baked", "pillow-native"]  # colour 后端很慢，需要时用 --backends 显式加入
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.15  # 最短耗时或内存峰值比基准高 15% 以上视为退化（最短耗时受系统噪声的影响最小）
+MEMORY_NOISE_MB = 4.0     # 内存峰值与基准相差不到这么多时不算退化：RSS 受分配器状态影响，同样的运行也会相差一两MB
+MEMORY_METRICS = ("peak_alloc_mb", "peak_rss_mb")
+SAMPLE_TEXTS = {
+    "简体短句": "夕阳把港口的每一条船都染成了金色，潮水转身之前，整座城市都屏住了呼吸。" * 3,
+    "英文散文": ("The quiet light of a late afternoon falls across the harbor, and for a moment every boat "
+                 "seems to hold its breath before the tide turns. ") * 3,
+}
+
+
+def make_synthetic_photo(size, seed):
+    """生成带渐变、色块和噪声的合成照片，固定种子保证每次运行输入完全相同"""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    red = 255 * x / width
+    green = 255 * y / height
+    blue = 127 + 127 * np.sin((x + y) / 97.0)
+    photo = np.stack([red, green, blue], axis=-1)
+    photo += rng.normal(0, 12, photo.shape).astype(np.float32)
+    return Image.fromarray(np.clip(photo, 0, 255).astype(np.uint8))
+
+
+def write_inputs(work_dir, resolutions):
+    """为每个分辨率写出3张不同的 JPEG，返回 {分辨率: [路径, ...]}"""
+    inputs = {}
+    for name in resolutions:
+        paths = []
+        for i in range(3):
+            path = os.path.join(work_dir, f"{name}_{i}.jpg")
+            make_synthetic_photo(RESOLUTIONS[name], seed=i).save(path, quality=92)
+            paths.append(path)
+        inputs[name] = paths
+    return inputs
+
+
+def measure(func, repeat):
+    """
+    先运行一次记为冷启动耗时（包含LUT解析、字体加载等一次性开销），再不开 tracemalloc 计时 repeat 次，
+    然后单独运行一次测量本阶段的RSS峰值增长，最后在 tracemalloc 下运行一次记录 Python 层面的内存分配峰值。
+    """
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    peak_rss = measure_peak_rss_mb(func)
+
+    tracemalloc.start()
+    func()
+    _, peak_alloc = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "cold_s": cold,
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "runs": len(times),
+        "peak_alloc_mb": peak_alloc / 1024 / 1024,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def measure_peak_rss_mb(func):
+    """
+    运行一次 func，返回运行期间进程RSS峰值比开始时高出多少（MB）。
+    进程级的 ru_maxrss 只会增长，第一次大尺寸解码之后每个阶段都会读到同一个数，所以这里在 Linux 上
+    通过 /proc/self/clear_refs 把峰值（VmHWM）重置为当前值，再读取本阶段结束时的峰值。
+    开始前先用 malloc_trim 把之前各次运行释放、但仍留在堆里的内存还给系统，否则本阶段会直接复用它们，
+    RSS 不再增长，测出来总是0。其他系统不支持重置峰值，返回 None（比较时跳过）。
+    """
+    if _libc is not None and hasattr(_libc, "malloc_trim"):
+        _libc.malloc_trim(0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # 5: 把 VmHWM 重置为当前的 RSS（Linux 4.0+）
+        start = _read_proc_status_kb("VmRSS")
+    except OSError:
+        return None
+    func()
+    peak = _read_proc_status_kb("VmHWM")
+    if start is None or peak is None:
+        return None
+    return max(0, peak - start) / 1024
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"))
+    except (OSError, TypeError):
+        return None
+
+
+_libc = _load_libc() if sys.platform.startswith("linux") else None
+
+
+def _read_proc_status_kb(field):
+    """读取 /proc/self/status 中以KB为单位的字段"""
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return None
+
+
+def run_benchmarks(inputs, filter_names, backends, repeat, include_canvas=True):
+    """依次测量各阶段，返回 {阶段名: 结果}"""
+    results = {}
+
+    def record(stage, func):
+        print(f"  {stage} ...", end="", flush=True)
+        results[stage] = measure(func, repeat)
+        print(f" {results[stage]['median_s'] * 1000:.1f} ms")
+
+    for resolution, paths in inputs.items():
+        print(f"[{resolution}]")
+        # 1. 解码：完整解码，以及按电影竖排尺寸的缩小解码
+        record(f"decode/full/{resolution}", lambda: [layouts.load_image(p) for p in paths])
+        record(f"decode/film_strip/{resolution}", lambda: [layouts.load_image(p, "电影竖排") for p in paths])
+
+        # 2. 每个滤镜、每个后端分别在原图上调色（冷启动时间包含LUT的解析和烘焙）
+        source = layouts.load_image(paths[0])
+        for filter_name in filter_names:
+            for backend in backends:
+                record(f"filter/{filter_name}/{backend}/{resolution}",
+                       lambda: lut_engine.apply_lut(source, filter_name, backend=backend))
+
+        # 3. 布局：输入是已经缩放到布局尺寸的图片（与 pipeline 中一致）
+        strip_inputs = [layouts.load_image(p, "电影竖排") for p in paths]
+        poster_inputs = [layouts.load_image(paths[0], "单张海报")]
+        record(f"layout/film_strip/{resolution}", lambda: layouts.create_film_strip_layout(strip_inputs))
+        record(f"layout/poster/{resolution}", lambda: layouts.create_poster_layout(poster_inputs))
+
+    # 4. 文字：换行和完整的文字绘制与照片分辨率无关，只测一次
+    print("[text]")
+    measure_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    font = font_registry.get_named_font(font_registry.DEFAULT_FONT_NAME, layouts.FILM_STRIP_FONT_SIZE)
+    for content_style, text in SAMPLE_TEXTS.items():
+        record(f"text/wrap_text/{content_style}", lambda: layouts.wrap_text(measure_draw, text, 560, font))
+
+    any_paths = next(iter(inputs.values()))
+    strip, strip_geometry = layouts.create_film_strip_layout([layouts.load_image(p, "电影竖排") for p in any_paths])
+    poster, poster_geometry = layouts.create_poster_layout([layouts.load_image(any_paths[0], "单张海报")])
+    texts = list(SAMPLE_TEXTS.values()) + ["短句"]
+    record("text/draw_text_on_image/film_strip",
+           lambda: layouts.draw_text_on_image(strip.copy(), texts, strip_geometry, font_registry.DEFAULT_FONT_NAME))
+    record("text/draw_text_on_image/poster",
+           lambda: layouts.draw_text_on_image(poster.copy(), texts, poster_geometry, font_registry.DEFAULT_FONT_NAME))
+
+    # 5. 预览画布的重绘需要图形界面，没有显示器时跳过
+    if include_canvas:
+        run_canvas_benchmarks(layouts.load_image(any_paths[0]), record)
+    return results
+
+
+def run_canvas_benchmarks(image, record):
+    """在隐藏的窗口中测量 ImageCanvas 的快速重绘、高质量重绘和放大后的重绘"""
+    try:
+        import customtkinter as ctk
+        from app_ui import ImageCanvas
+        root = ctk.CTk()
+    except Exception as e:
+        print(f"[canvas] 跳过（无法创建窗口: {e}）")
+        return
+
+    try:
+        root.withdraw()
+        root.geometry("1000x800")
+        canvas = ImageCanvas(root)
+        canvas.pack(fill="both", expand=True)
+        root.update()
+        canvas.show_image(image)
+        print("[canvas]")
+        record("canvas/redraw_fast", lambda: canvas._redraw_image(high_quality=False))
+        record("canvas/redraw_high_quality", lambda: canvas._redraw_image(high_quality=True))
+        canvas.scale *= 4
+        record("canvas/redraw_zoomed", lambda: canvas._redraw_image(high_quality=False))
+        canvas._cancel_refine()
+    finally:
+        root.destroy()
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    逐阶段比较最短耗时和内存峰值（tracemalloc 分配峰值、RSS峰值增长），打印对比表，返回退化的阶段列表。
+    内存比基准高出 threshold 比例、并且绝对值多出 MEMORY_NOISE_MB 以上才算退化；基准中没有的指标跳过。
+    """
+    regressions = []
+    print(f"\n=== 与基准比较（阈值 +{threshold:.0%}）===")
+    for stage, result in results.items():
+        base = baseline.get("results", {}).get(stage)
+        if base is None:
+            print(f"  {'新增':>8}  {stage}")
+            continue
+        ratio = result["min_s"] / base["min_s"] if base["min_s"] else float("inf")
+        regressed = ratio > 1 + threshold
+        flag = "退化" if regressed else ("提升" if ratio < 1 - threshold else "持平")
+        print(f"  {flag:>6} {ratio:6.2f}x  {base['min_s'] * 1000:9.1f} -> {result['min_s'] * 1000:9.1f} ms  {stage}")
+
+        for metric in MEMORY_METRICS:
+            before, after = base.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + threshold) and after - before > MEMORY_NOISE_MB:
+                regressed = True
+                print(f"  {'退化':>6} {metric}  {before:9.1f} -> {after:9.1f} MB  {stage}")
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+
+def get_metadata(repeat):
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "repeat": repeat,
+    }
+
+
+def get_available_filters():
+    if not os.path.isdir(lut_engine.LUT_DIR):
+        return []
+    return sorted(f[:-5] for f in os.listdir(lut_engine.LUT_DIR) if f.endswith(".cube"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="渲染流程各阶段的基准测试")
+    parser.add_argument("-o", "--output", help="把结果写入这个 JSON 文件")
+    parser.add_argument("--baseline", help="与这个 JSON 基准结果比较")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"最短耗时或内存峰值超过基准多少比例视为退化（默认: {DEFAULT_THRESHOLD}）")
+    parser.add_argument("--resolutions", nargs="+", default=DEFAULT_RESOLUTIONS, choices=list(RESOLUTIONS),
+                        help="合成照片的分辨率")
+    parser.add_argument("--filters", nargs="+", default=None, help="要测量的滤镜（默认: luts 目录中的全部）")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS, choices=lut_engine.FILTER_BACKENDS,
+                        help="要测量的滤镜后端")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="每个阶段预热后计时的次数")
+    parser.add_argument("--no-canvas", action="store_true", help="不测量预览画布的重绘")
+    args = parser.parse_args(argv)
+
+    filter_names = args.filters if args.filters is not None else get_available_filters()
+    work_dir = tempfile.mkdtemp(prefix="collage_bench_")
+    try:
+        print("正在生成合成照片...")
+        inputs = write_inputs(work_dir, args.resolutions)
+        results = run_benchmarks(inputs, filter_names, args.backends, args.repeat, not args.no_canvas)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"meta": get_metadata(args.repeat), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} 个阶段出现性能退化。")
+            return 1
+        print("\n没有发现性能退化。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# file: exporter.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+# --- 编码预设：在编码耗时和文件大小之间取舍 ---
+# 每个预设为各格式分别给出 Pillow 的保存参数
+EXPORT_PRESETS = {
+    "最快": {
+        "png": {"compress_level": 1},
+        "jpeg": {"quality": 92},
+        "webp": {"quality": 90, "method": 0},
+        "webp-lossless": {"lossless": True, "quality": 0, "method": 0},
+    },
+    "均衡": {
+        "png": {"compress_level": 6},
+        "jpeg": {"quality": 92, "optimize": True},
+        "webp": {"quality": 90, "method": 4},
+        "webp-lossless": {"lossless": True, "quality": 50, "method": 4},
+    },
+    "最小": {
+        "png": {"compress_level": 9},
+        "jpeg": {"quality": 90, "optimize": True, "progressive": True},
+        "webp": {"quality": 85, "method": 6},
+        "webp-lossless": {"lossless": True, "quality": 100, "method": 6},
+    },
+}
+DEFAULT_PRESET = "均衡"
+
+# 格式 -> (Pillow 格式名, 文件扩展名)
+EXPORT_FORMATS = {
+    "png": ("PNG", ".png"),
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "webp-lossless": ("WEBP", ".webp"),
+}
+EXTENSION_FORMATS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp"}
+EXPORT_WORKERS = min(4, os.cpu_count() or 1)  # 同时编码的文件数；Pillow 编码时会释放GIL，线程可以真正并行
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def format_from_path(path, webp_lossless=False):
+    """根据扩展名判断格式，无法识别时按 PNG 处理；webp_lossless 为 True 时 .webp 按无损 WebP 编码"""
+    format_key = EXTENSION_FORMATS.get(os.path.splitext(path)[1].lower(), "png")
+    return "webp-lossless" if webp_lossless and format_key == "webp" else format_key
+
+
+def get_save_options(format_key, preset=DEFAULT_PRESET):
+    """返回 (Pillow 格式名, 保存参数)"""
+    if preset not in EXPORT_PRESETS:
+        raise ValueError(f"未知的导出预设: {preset}，可选: {', '.join(EXPORT_PRESETS)}")
+    if format_key not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {format_key}，可选: {', '.join(EXPORT_FORMATS)}")
+    return EXPORT_FORMATS[format_key][0], dict(EXPORT_PRESETS[preset][format_key])
+
+
+def get_png_compress_level(preset=DEFAULT_PRESET):
+    """预设对应的 PNG 压缩级别，供流式PNG写入使用"""
+    return get_save_options("png", preset)[1]["compress_level"]
+
+
+def with_format_extension(path, format_key):
+    """把路径的扩展名换成格式对应的扩展名，用于同一张图同时导出多种格式"""
+    return os.path.splitext(path)[0] + EXPORT_FORMATS[format_key][1]
+
+
+def save_image(image, path, format_key=None, preset=DEFAULT_PRESET):
+    """
+    【原子写入】按预设编码后先写入同一目录下的临时文件，完成后再改名为目标文件，
+    中途出错或被中断都不会留下写了一半的文件，也不会破坏已有的同名文件。返回 path。
+    """
+    format_key = format_key or format_from_path(path)
+    pillow_format, options = get_save_options(format_key, preset)
+    if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with tracing.span("save", format=format_key, preset=preset) as save_span:
+        try:
+            image.save(tmp_path, format=pillow_format, **options)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        save_span.set(file_bytes=os.path.getsize(path))
+    return path
+
+
+def get_export_pool():
+    """导出专用的线程池，第一次使用时才创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="exporter")
+        return _pool
+
+
+def submit_export(image, outputs, preset=DEFAULT_PRESET):
+    """
+    在后台线程池中编码并写出同一张图片的多个文件，立即返回，不等待编码完成。
+    outputs 为 [(路径, 格式), ...]，格式为 None 时按扩展名判断。返回与 outputs 一一对应的 Future 列表，
+    每个 Future 的结果是写出的路径。各文件之间并行编码；图片在编码期间不能再被修改。
+    """
+    pool = get_export_pool()
+    return [pool.submit(save_image, image, path, format_key, preset) for path, format_key in outputs]
+
+
+def export_image(image, outputs, preset=DEFAULT_PRESET):
+    """与 submit_export 相同，但等待全部文件写完，返回路径列表；任何一个失败都会抛出它的异常"""
+    return [future.result() for future in submit_export(image, outputs, preset)]
@@ -0,0 +1,217 @@
+# file: font_registry.py
+import json
+import os
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+# --- 字体缓存参数 ---
+FONT_DIR = "fonts"
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+DEFAULT_FONT_NAME = "默认"     # 界面和命令行中表示 Pillow 内置默认字体的名称
+FONT_CACHE_SIZE = 16          # 进程内最多同时保留的字体对象数量（同一字体的不同字号分别计数）
+INDEX_FILE_NAME = os.path.join(".cache", "index.json")  # 字体索引缓存，放在 fonts/.cache/ 下
+INDEX_VERSION = 1             # 索引格式版本，格式或检测方法变化时加一即可让旧索引失效
+
+# 检测字体支持哪些文字时使用的样例字符：样例全部能正常显示才算支持
+SCRIPT_SAMPLES = {
+    "latin": "Aa",
+    "han": "永字",
+    "kana": "あア",
+    "hangul": "한",
+}
+NOTDEF_PROBE = "\U0010FFFD"   # 私用区字符，几乎没有字体包含它，画出来就是该字体的缺字符号（.notdef）
+PROBE_SIZE = 32
+
+# 索引中的一个字体：.ttc 字体集合里的每个字体分别是一项
+FontFace = namedtuple("FontFace", ["file_name", "index", "family", "style", "scripts"])
+
+_index_lock = threading.Lock()
+_index_entries = {}  # 文件名 -> {"mtime_ns", "size", "faces"}，与 fonts/.cache/index.json 的内容一致
+
+
+def get_font(font_path, size, index=0):
+    """
+    【带缓存的字体加载】
+    每个 (文件, 字号, 字体序号) 在一个进程内只加载一次，结果保存在有上限的LRU缓存中。
+    大型中日韩字体动辄几十MB，批量渲染时加载只发生一次，而不是每张图一次。
+    文件不存在或无法解析时抛出 OSError。
+    """
+    stat = os.stat(font_path)
+    # 把修改时间和文件大小放进缓存键里，字体文件被替换后自动重新加载
+    return _load_font_cached(font_path, stat.st_mtime_ns, stat.st_size, size, index)
+
+
+def get_default_font(size=None):
+    """
+    Pillow 的内置默认字体，每个字号只加载一次。必须传入字号：不带字号的 load_default() 总是10像素的点阵字体，
+    与布局中按字号计算的行高不符，预览代理图上的文字也不会随比例缩小。size 为 None 时才返回点阵字体。
+    """
+    return _load_default_font(size)
+
+
+def get_named_font(font_name, size, font_dir=FONT_DIR):
+    """
+    按界面/命令行中的字体名称取字体：fonts 目录中的文件名，或“默认”。
+    字体加载失败时打印原因并退回默认字体，与之前直接调用 truetype 的行为一致。
+    """
+    if font_name == DEFAULT_FONT_NAME:
+        return get_default_font(size)
+    try:
+        return get_font(os.path.join(font_dir, font_name), size)
+    except OSError as e:
+        print(f"加载字体 {font_name} 失败，改用默认字体: {e}")
+        return get_default_font(size)
+
+
+def get_font_file_key(font_name, font_dir=FONT_DIR):
+    """
+    字体名称对应文件的 (路径, 修改时间, 文件大小)，供渲染结果的缓存键使用：字体文件被替换后键随之改变。
+    “默认”字体或文件不存在时返回名称本身（此时绘制使用默认字体）。
+    """
+    if font_name == DEFAULT_FONT_NAME:
+        return font_name
+    font_path = os.path.join(font_dir, font_name)
+    try:
+        stat = os.stat(font_path)
+    except OSError:
+        return font_name
+    return (font_path, stat.st_mtime_ns, stat.st_size)
+
+
+def clear_font_cache():
+    """清空进程内的字体缓存"""
+    _load_font_cached.cache_clear()
+    _load_default_font.cache_clear()
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load_font_cached(font_path, mtime_ns, file_size, size, index):
+    return ImageFont.truetype(font_path, size, index=index)
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load_default_font(size):
+    if size is None:
+        return ImageFont.load_default()
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()  # Pillow 10.1 之前的版本不支持字号
+
+
+def get_font_index(font_dir=FONT_DIR):
+    """
+    【字体索引】返回 fonts 目录中所有字体的列表 [FontFace, ...]，按文件名排序。
+    每个文件只在第一次出现或修改时间、大小变化时才被打开分析（读取字体名称、检测支持的文字），
+    结果同时写入 fonts/.cache/index.json，下次启动直接读取。
+    """
+    with _index_lock:
+        if not _index_entries:
+            _index_entries.update(_read_index(font_dir))
+
+        try:
+            file_names = sorted(f for f in os.listdir(font_dir) if f.lower().endswith(FONT_EXTENSIONS))
+        except FileNotFoundError:
+            file_names = []
+
+        stats = {}
+        for file_name in file_names:
+            try:
+                stats[file_name] = os.stat(os.path.join(font_dir, file_name))
+            except OSError:
+                pass  # 列出目录之后才被删除的字体，与无法解析的文件一样跳过
+        file_names = [file_name for file_name in file_names if file_name in stats]
+
+        changed = False
+        for file_name in set(_index_entries) - set(file_names):
+            del _index_entries[file_name]  # 已被删除的字体
+            changed = True
+
+        for file_name in file_names:
+            stat = stats[file_name]
+            entry = _index_entries.get(file_name)
+            if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                continue
+            _index_entries[file_name] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "faces": _inspect_font_file(os.path.join(font_dir, file_name)),
+            }
+            changed = True
+
+        if changed:
+            _write_index(font_dir, _index_entries)
+
+        return [FontFace(file_name, face["index"], face["family"], face["style"], tuple(face["scripts"]))
+                for file_name in file_names
+                for face in _index_entries[file_name]["faces"]]
+
+
+def _inspect_font_file(font_path):
+    """打开字体文件中的每个字体，读取名称并检测支持的文字；无法解析的文件返回空列表"""
+    faces = []
+    index = 0
+    while True:
+        try:
+            font = ImageFont.truetype(font_path, PROBE_SIZE, index=index)
+        except OSError:
+            break  # .ttc 中的字体已经全部读完，或者文件本身无法解析
+        family, style = font.getname()
+        faces.append({"index": index, "family": family, "style": style, "scripts": detect_scripts(font)})
+        if not font_path.lower().endswith(".ttc"):
+            break
+        index += 1
+    if not faces:
+        print(f"无法解析字体文件，已跳过: {font_path}")
+    return faces
+
+
+def detect_scripts(font):
+    """
+    检测字体支持哪些文字：把样例字符画出来，与该字体的缺字符号（.notdef）比较，
+    画出来和缺字符号一模一样就说明字体里没有这个字。
+    """
+    notdef = _render_glyph(font, NOTDEF_PROBE)
+    return [script for script, samples in SCRIPT_SAMPLES.items()
+            if all(_render_glyph(font, char) != notdef for char in samples)]
+
+
+def _render_glyph(font, char):
+    canvas = Image.new("L", (PROBE_SIZE * 2, PROBE_SIZE * 2))
+    ImageDraw.Draw(canvas).text((0, 0), char, font=font, fill=255)
+    return canvas.tobytes()
+
+
+def _read_index(font_dir):
+    """读取磁盘上的索引缓存，版本不符或文件损坏时返回空字典"""
+    try:
+        with open(os.path.join(font_dir, INDEX_FILE_NAME), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != INDEX_VERSION:
+            return {}
+        return data["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def _write_index(font_dir, entries):
+    """写入索引缓存。先写临时文件再改名，避免其他进程读到写了一半的文件"""
+    index_path = os.path.join(font_dir, INDEX_FILE_NAME)
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "files": entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        # 目录只读等情况下，索引写不进去也不影响使用
+        print(f"写入字体索引缓存失败（不影响使用）: {e}")
+
+
+if __name__ == "__main__":
+    # 直接运行本文件时，列出 fonts 目录中的全部字体
+    for face in get_font_index():
+        print(f"{face.file_name}[{face.index}]  {face.family} {face.style}  支持: {', '.join(face.scripts) or '未知'}")
@@ -1,26 +1,204 @@
 # file: layouts.py
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
 import numpy as np
-import colour
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ExifTags
+import font_registry
+import lut_engine
+
+# --- 各布局中照片的目标尺寸，布局函数、文字绘制和预缩放共用 ---
+FILM_STRIP_IMAGE_WIDTH = 600  # 电影竖排中每张照片统一缩放到的宽度
+FILM_STRIP_SIDEBAR_WIDTH = 60  # 电影竖排两侧齿孔边栏的宽度
+FILM_STRIP_GAP = 25           # 电影竖排“保留间隙”样式中照片之间的间隙
+FILM_STRIP_HOLE_SIZE = 12     # 电影竖排齿孔的边长
+POSTER_MAX_WIDTH = 800        # 单张海报中照片的最大宽度
+POSTER_SIDE_PADDING = 50      # 单张海报上、左、右三边的边框宽度
+POSTER_BOTTOM_PADDING = 180   # 单张海报底部的边框宽度，留出写字的空间
+FILM_STRIP_TEXT_MARGIN = 20   # 电影竖排中文字与照片左、右、下边缘的距离
+POSTER_TEXT_GAP = 40          # 单张海报中照片下边缘与第一行文字的距离
+FILM_STRIP_FONT_SIZE = 28
+POSTER_FONT_SIZE = 40
+FALLBACK_TEXTS = ["未能获取文字"]  # 需要绘制文字却没有拿到任何文字时显示的内容
+
+# 【布局几何】布局函数拼图时算出的全部位置信息，文字绘制直接使用，不必再根据原图重新推算。
+# canvas_size: 画布尺寸 (宽, 高)；frames: 每张照片在画布上的矩形 (x0, y0, x1, y1)；
+# text_regions: 每段文字可用的矩形区域（与文字一一对应）；font_size: 按比例缩放后的字号。
+LayoutGeometry = namedtuple("LayoutGeometry", ["layout_style", "canvas_size", "frames", "text_regions",
+                                               "font_size"])
+
+
+def scaled(value, scale):
+    """
+    把布局中的像素尺寸按比例缩放，scale 为1时原样返回。
+    预览时整个布局（照片、边框、齿孔、文字）都按同一比例缩小，得到与成品几何一致的代理图。
+    """
+    if scale == 1:
+        return value
+    return max(1, round(value * scale))
+
+
+def resolve_target_size(size, layout_style, scale=1.0):
+    """
+    【布局几何】根据原图尺寸 (宽, 高) 计算它在指定布局中最终的像素尺寸。
+    计算方式与各布局函数内部的缩放完全一致。scale 小于1时得到预览代理图中的尺寸。
+    """
+    width, height = size
+    if layout_style == "电影竖排":
+        target_width = scaled(FILM_STRIP_IMAGE_WIDTH, scale)
+    elif layout_style == "单张海报":
+        if width <= POSTER_MAX_WIDTH and scale == 1:
+            return width, height
+        target_width = scaled(min(width, POSTER_MAX_WIDTH), scale)
+    else:
+        raise ValueError(f"未知的布局: {layout_style}")
+    ratio = target_width / width
+    return target_width, max(1, int(height * ratio))
+
+
+def read_image_size(path):
+    """只读取文件头，返回按 EXIF 方向转正后的图片尺寸 (宽, 高)，不解码像素"""
+    with Image.open(path) as image:
+        orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+        return image.size[::-1] if orientation in (5, 6, 7, 8) else image.size
+
+
+def build_layout_geometry(photo_sizes, layout_style, style="保留间隙", scale=1.0):
+    """
+    根据照片在布局中的尺寸（已缩放到布局宽度，见 resolve_target_size）计算整张图的布局几何。
+    布局函数和 pipeline 中的预览比例计算都用它，只需要尺寸，不需要像素。
+    """
+    if layout_style == "电影竖排":
+        image_width = scaled(FILM_STRIP_IMAGE_WIDTH, scale)
+        sidebar_width = scaled(FILM_STRIP_SIDEBAR_WIDTH, scale)
+        gap = scaled(FILM_STRIP_GAP, scale) if style == "保留间隙" else 0
+        margin = scaled(FILM_STRIP_TEXT_MARGIN, scale)
+
+        frames, text_regions = [], []
+        current_y = 0
+        for _, height in photo_sizes:
+            frames.append((sidebar_width, current_y, sidebar_width + image_width, current_y + height))
+            # 文字贴着照片底部，左右和底部各留出 margin
+            text_regions.append((sidebar_width + margin, current_y,
+                                 sidebar_width + image_width - margin, current_y + height - margin))
+            current_y += height + gap
+        total_height = current_y - gap if frames else 0
+        canvas_size = (sidebar_width + image_width + sidebar_width, total_height)
+        font_size = scaled(FILM_STRIP_FONT_SIZE, scale)
+
+    elif layout_style == "单张海报":
+        side_padding = scaled(POSTER_SIDE_PADDING, scale)
+        photo_width, photo_height = photo_sizes[0]
+        canvas_size = (side_padding + photo_width + side_padding,
+                       side_padding + photo_height + scaled(POSTER_BOTTOM_PADDING, scale))
+        frames = [(side_padding, side_padding, side_padding + photo_width, side_padding + photo_height)]
+        # 文字区域在照片下边缘再往下一点，左右与照片对齐，一直延伸到画布底部
+        text_top = side_padding + photo_height + scaled(POSTER_TEXT_GAP, scale)
+        text_regions = [(side_padding, text_top, canvas_size[0] - side_padding, canvas_size[1])]
+        font_size = scaled(POSTER_FONT_SIZE, scale)
+
+    else:
+        raise ValueError(f"未知的布局: {layout_style}")
+
+    return LayoutGeometry(layout_style, canvas_size, tuple(frames), tuple(text_regions), font_size)
+
+
+# EXIF 方向值对应的旋转/翻转方式，与 ImageOps.exif_transpose 保持一致
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def load_image(path, layout_style=None, scale=1.0):
+    """
+    【按需解码的图片加载器】
+    已知布局时，只解码到刚好够用的分辨率：JPEG 利用 DCT 缩放（draft）直接以 1/2、1/4、1/8 解码，
+    其他格式解码后用 reduce() 做整数倍缩小，最后再用 LANCZOS 缩放到布局中的精确尺寸。
+    同时按 EXIF 方向信息把照片转正。layout_style 为 None 时按原始分辨率加载。
+    scale 小于1时直接解码到预览代理图中的尺寸，大尺寸照片也只需解码很少的像素。
+    """
+    image = Image.open(path)
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    transpose_method = EXIF_ORIENTATION_TRANSPOSE.get(orientation)
+    swap_axes = orientation in (5, 6, 7, 8)  # 这几种方向转正后宽高互换
+
+    if layout_style is None:
+        image.load()
+        return image.transpose(transpose_method) if transpose_method is not None else image
+
+    # 1. 按转正后的尺寸计算布局中的目标尺寸，再换算回文件中的存储方向
+    display_size = image.size[::-1] if swap_axes else image.size
+    target_size = resolve_target_size(display_size, layout_style, scale)
+    stored_target = target_size[::-1] if swap_axes else target_size
+
+    # 2. JPEG 在解码阶段直接缩小，结果尺寸不会小于 stored_target
+    if image.format == "JPEG":
+        image.draft(image.mode, stored_target)
+    image.load()
+    image = _convert_for_resampling(image)
+
+    # 3. 再用整数倍缩小，取不低于目标尺寸的最大2的幂
+    factor = 1
+    while (image.width // (factor * 2) >= stored_target[0]
+           and image.height // (factor * 2) >= stored_target[1]):
+        factor *= 2
+    if factor > 1:
+        image = image.reduce(factor)
+
+    # 4. 转正后做最后一次高质量缩放，得到与全分辨率解码完全相同的布局尺寸
+    if transpose_method is not None:
+        image = image.transpose(transpose_method)
+    if image.size != target_size:
+        image = image.resize(target_size, Image.Resampling.LANCZOS)
+    return image
+
+
+def _convert_for_resampling(image):
+    """
+    调色板（P/PA）、1位和16位灰度图片不能 reduce，LANCZOS 缩放也不适用于调色板索引，
+    先转换成 RGB（带透明信息时为 RGBA），之后的滤镜本来也会转换成 RGB。
+    """
+    if image.mode not in ("P", "PA", "1") and not image.mode.startswith("I;16"):
+        return image
+    if image.mode == "PA" or "transparency" in image.info:
+        return image.convert("RGBA")
+    return image.convert("RGB")
 
 
-def create_film_strip_layout(images, style="保留间隙"):
+def fit_images_to_layout(images, layout_style):
+    """
+    【先缩放后调色】把图片预先缩放到布局中的最终尺寸。
+    之后再应用滤镜，只需处理真正会出现在成品里的像素；布局函数遇到尺寸已经一致的图片时不会再次缩放。
+    """
+    if layout_style == "单张海报":
+        images = images[:1]  # 海报只用第一张照片
+    fitted_images = []
+    for img in images:
+        target_size = resolve_target_size(img.size, layout_style)
+        if target_size != img.size:
+            img = img.resize(target_size, Image.Resampling.LANCZOS)
+        fitted_images.append(img)
+    return fitted_images
+
+
+def create_film_strip_layout(images, style="保留间隙", scale=1.0):
     """
     【功能确认版】
     确保胶卷边框和齿孔效果能正确显示。
+    scale 小于1时生成预览代理图，传入的图片应已用 load_image 按相同比例解码。
+    返回 (拼好的图片, LayoutGeometry)。
     """
     # --- 1. 定义布局参数 ---
-    image_width = 600
-    sidebar_width = 60
+    image_width = scaled(FILM_STRIP_IMAGE_WIDTH, scale)
+    sidebar_width = scaled(FILM_STRIP_SIDEBAR_WIDTH, scale)
 
-    if style == "保留间隙":
-        gap = 25
-    else:  # "无缝拼接"
-        gap = 0
-
-    hole_size = 12
-    hole_margin = (sidebar_width - hole_size) // 2
-    hole_spacing = hole_size * 2.5
+    hole_size = scaled(FILM_STRIP_HOLE_SIZE, scale)
 
     # --- 2. 准备图片 ---
     resized_images = []
@@ -29,204 +207,258 @@ def create_film_strip_layout(images, style="保留间隙"):
         target_height = int(img.height * ratio)
         resized_images.append(img.resize((image_width, target_height), Image.Resampling.LANCZOS))
 
-    # --- 3. 创建画布 ---
-    total_image_height = sum(img.height for img in resized_images)
-    total_gap_height = gap * (len(resized_images) - 1)
-    total_height = total_image_height + total_gap_height
-    total_width = sidebar_width + image_width + sidebar_width
+    # --- 3. 计算布局几何并创建画布 ---
+    geometry = build_layout_geometry([img.size for img in resized_images], "电影竖排", style, scale)
 
-    composed_image = Image.new('RGB', (total_width, total_height), 'black')
+    composed_image = Image.new('RGB', geometry.canvas_size, 'black')
 
     # --- 4. 粘贴图片 ---
-    current_y = 0
-    for img in resized_images:
-        composed_image.paste(img, (sidebar_width, current_y))
-        current_y += img.height + gap
+    for img, frame in zip(resized_images, geometry.frames):
+        composed_image.paste(img, frame[:2])
+
+    # --- 5. 贴上两侧的齿孔边栏（同一张缓存的边栏图片，左右各贴一次） ---
+    sprocket_column = get_sprocket_column(geometry.canvas_size[1], sidebar_width, hole_size)
+    composed_image.paste(sprocket_column, (0, 0))
+    composed_image.paste(sprocket_column, (sidebar_width + image_width, 0))
+
+    return composed_image, geometry
+
+
+SPROCKET_HOLE_COLOR = (25, 25, 25)
+SPROCKET_TILE_ROWS = 4096  # 缓存的齿孔边栏按这个行数的整数倍生成，高度相近的胶卷共用同一张
+
+
+def get_sprocket_band(top, height, sidebar_width, hole_size):
+    """
+    返回齿孔边栏中从第 top 行开始、高 height 行的一段，以及这一段在返回图片中的起始行。
+    齿孔按固定周期重复，所以只需在缓存的边栏上找到相位相同的位置，不必生成整条长胶卷的边栏。
+    """
+    hole_spacing = hole_size * 2.5
+    first_row, period = int(hole_spacing // 2), int(hole_spacing)
+    offset = top if top < first_row else first_row + (top - first_row) % period
+    return get_sprocket_column(offset + height, sidebar_width, hole_size), offset
 
-    # --- 5. 绘制边孔 ---
-    draw = ImageDraw.Draw(composed_image)
-    hole_color = (25, 25, 25)
 
-    for y in range(int(hole_spacing // 2), total_height, int(hole_spacing)):
-        left_hole_x0 = hole_margin
-        left_hole_y0 = y
-        left_hole_x1 = left_hole_x0 + hole_size
-        left_hole_y1 = y + hole_size
-        draw.rectangle([left_hole_x0, left_hole_y0, left_hole_x1, left_hole_y1], fill=hole_color)
+def get_sprocket_column(height, sidebar_width, hole_size):
+    """
+    返回一条不低于 height 的齿孔边栏（黑底，每隔 2.5 个孔的距离一个齿孔）。
+    齿孔图案从顶部开始按固定周期重复，高度相近的胶卷直接共用缓存中的同一条边栏：
+    它可能比画布更高，粘贴时超出画布的部分会被自动裁掉，不需要再复制一份。
+    """
+    tile_height = -(-height // SPROCKET_TILE_ROWS) * SPROCKET_TILE_ROWS
+    return _render_sprocket_column(tile_height, sidebar_width, hole_size)
 
-        right_hole_x0 = image_width + sidebar_width + hole_margin
-        right_hole_y0 = y
-        right_hole_x1 = right_hole_x0 + hole_size
-        right_hole_y1 = y + hole_size
-        draw.rectangle([right_hole_x0, right_hole_y0, right_hole_x1, right_hole_y1], fill=hole_color)
 
-    return composed_image
+@lru_cache(maxsize=8)
+def _render_sprocket_column(height, sidebar_width, hole_size):
+    """用 NumPy 一次性画出整条边栏；齿孔范围与逐个 ImageDraw.rectangle（含右、下边界）完全一致"""
+    hole_margin = (sidebar_width - hole_size) // 2
+    hole_spacing = hole_size * 2.5
+    first_row, period = int(hole_spacing // 2), int(hole_spacing)
 
+    rows = np.arange(height)
+    hole_rows = (rows >= first_row) & ((rows - first_row) % period <= hole_size)
+    column = np.zeros((height, sidebar_width, 3), dtype=np.uint8)
+    column[hole_rows, hole_margin:hole_margin + hole_size + 1] = SPROCKET_HOLE_COLOR
+    return Image.fromarray(column)
 
-def create_poster_layout(images):
+
+def create_poster_layout(images, scale=1.0):
     """
     【最终版 - 参照用户图片】
     实现非对称的“拍立得/画廊打印”风格，顶部和两侧是窄边，底部是宽边。
+    scale 小于1时生成预览代理图，传入的图片应已用 load_image 按相同比例解码。
+    返回 (拼好的图片, LayoutGeometry)。
     """
     # --- 1. 定义画框参数 ---
-    # 非对称边框，顶部和两侧使用一个尺寸，底部使用一个更宽的尺寸
-    side_padding = 50       # 上、左、右三边的边框宽度
-    bottom_padding = 180    # 底部边框的宽度，留出更多空间
+    # 非对称边框，顶部和两侧较窄，底部更宽（尺寸见 POSTER_SIDE_PADDING、POSTER_BOTTOM_PADDING）
     frame_color = (255, 255, 255) # 纯白色画框
 
     # --- 2. 准备图片 ---
     image = images[0]
     # 设定一个最大宽度，防止图片过大
-    max_width = 800
+    max_width = scaled(POSTER_MAX_WIDTH, scale)
     if image.width > max_width:
         ratio = max_width / image.width
         new_height = int(image.height * ratio)
         image = image.resize((max_width, new_height), Image.Resampling.LANCZOS)
     
     # --- 3. 计算最终画布尺寸 ---
-    # 画布的宽度 = 左边框 + 图片宽度 + 右边框
-    canvas_width = side_padding + image.width + side_padding
-    # 画布的高度 = 上边框 + 图片高度 + 下边框
-    canvas_height = side_padding + image.height + bottom_padding
+    # 画布的宽度 = 左边框 + 图片宽度 + 右边框；高度 = 上边框 + 图片高度 + 下边框
+    geometry = build_layout_geometry([image.size], "单张海报", scale=scale)
     
     # --- 4. 创建纯白画布并粘贴图片 ---
     # 这次的逻辑更简单：先创建一块纯白的“相纸”
-    final_image = Image.new('RGB', (canvas_width, canvas_height), frame_color)
+    final_image = Image.new('RGB', geometry.canvas_size, frame_color)
     
-    # 然后，把用户的照片精确地“贴”在相纸的正确位置上
-    # X坐标 = 左边框宽度
-    # Y坐标 = 上边框宽度
-    paste_position = (side_padding, side_padding)
-    final_image.paste(image, paste_position)
+    # 然后，把用户的照片精确地“贴”在相纸的正确位置上（左上角是上边框和左边框的宽度）
+    final_image.paste(image, geometry.frames[0][:2])
     
-    return final_image
+    return final_image, geometry
 
 
-def apply_filter(image, filter_name):
+def apply_filter(image, filter_name, backend=lut_engine.DEFAULT_BACKEND):
     """
-    【再次修正版】
-    使用 'colour-science' 库更稳定的方法来应用LUT滤镜。
+    【多后端版】
+    backend 可选（详见 lut_engine）:
+      "numpy-baked":   默认。把LUT烘焙成8位查找表后直接查表，速度快、内存占用低。
+      "pillow-native": 使用 Pillow 的C实现 Color3DLUT，释放GIL，适合多线程处理。
+      "colour":        使用 'colour-science' 库的浮点插值，作为精度参照。
+    前两种后端与 colour 结果的误差不超过1个色阶。
+    filter_name 也可以是LUT配方，比如 "ColdChrome@60" 或 "A>B@60"（见 lut_engine.parse_recipe）。
     """
     if filter_name == "无":
         return image
 
     try:
-        lut_path = f"luts/{filter_name}.cube"
-
-        # 1. 使用 colour.io.luts.read_LUT 方法加载LUT (根据项目规范)
-        lut = colour.io.luts.read_LUT(lut_path)
+        return lut_engine.apply_lut(image, filter_name, backend=backend)
 
-        # 2. 将Pillow图片转换为NumPy数组，并确保颜色值在0-1之间
-        image = image.convert("RGB")  # 确保是RGB格式
-        image_array = np.array(image) / 255.0
-
-        # 3. 应用LUT
-        filtered_array = lut.apply(image_array)
-
-        # 4. 将处理后的0-1浮点数数组转换回0-255的整数数组
-        filtered_array_8bit = (np.clip(filtered_array, 0, 1) * 255).astype(np.uint8)
-
-        # 5. 将NumPy数组转换回Pillow图片对象
-        return Image.fromarray(filtered_array_8bit)
-
-    except FileNotFoundError:
-        print(f"错误：找不到滤镜文件 {lut_path}！请检查luts文件夹和文件名。")
+    except FileNotFoundError as e:
+        print(f"错误：找不到滤镜文件 {e.filename}！请检查luts文件夹和文件名。")
         return image
     except Exception as e:
         print(f"应用滤镜时发生错误: {e}")
         return image
 
 
-def draw_text_on_image(image, texts, layout_style, font_name, original_images, layout_params):
+def draw_text_on_image(image, texts, geometry, font_name):
     """
-    【终极修正版】
-    修正了单张海报布局的文字Y坐标计算问题。
+    【按布局几何绘制文字】
+    文字的位置和字号全部来自布局函数返回的 geometry，不需要原图，也不用重复推算缩放。
+    单张海报：文字在照片下方的区域内逐行居中；电影竖排：每段文字贴着对应照片的左下角。
     """
     if not texts:
-        texts = ["未能获取文字"]
+        texts = FALLBACK_TEXTS
 
     draw = ImageDraw.Draw(image)
-    font_path = f"fonts/{font_name}" if font_name != "默认" else None
+    font_size = geometry.font_size
+    font = font_registry.get_named_font(font_name, font_size)  # 字体对象在进程内缓存，不会每次重新加载
 
-    if layout_style == "单张海报":
-        text = texts[0]
-        font_size = 40
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-        except IOError:
-            font = ImageFont.load_default()
-
-        # 【核心修正】精确计算文字写入位置
-        # 1. 获取原始照片尺寸信息，以便定位照片下边缘
-        side_padding = 50  # 这个值必须和 create_poster_layout 中的一致
-        max_width = 800  # 这个值也必须一致
-        original_photo = original_images[0]
-        if original_photo.width > max_width:
-            ratio = max_width / original_photo.width
-            photo_height = int(original_photo.height * ratio)
-        else:
-            photo_height = original_photo.height
-
-        # 2. 计算文字区域和起始Y坐标
-        # 文字区域的顶部，在照片下边缘再往下一点
-        text_area_top_y = side_padding + photo_height + 40  # 40是照片与文字的间距
-
-        text_area_width = image.width - (side_padding * 2)
-        wrapped_lines = wrap_text(draw, text, text_area_width, font)
-
-        # 3. 逐行绘制
-        current_y = text_area_top_y
+    if geometry.layout_style == "单张海报":
+        x0, y0, x1, _ = geometry.text_regions[0]
+        wrapped_lines = wrap_text(draw, texts[0], x1 - x0, font)
+
+        # 逐行绘制，水平居中，1.2倍行距
+        current_y = y0
         for line in wrapped_lines:
             line_bbox = draw.textbbox((0, 0), line, font=font)
             line_width = line_bbox[2] - line_bbox[0]
-            line_x = (image.width - line_width) / 2  # 水平居中
+            line_x = (x0 + x1 - line_width) / 2
             draw.text((line_x, current_y), line, font=font, fill=(50, 50, 50))
-            current_y += font_size * 1.2  # 1.2倍行距
-
-    elif layout_style == "电影竖排":
-        # ... (这部分逻辑保持不变) ...
-        font_size = 28
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-        except IOError:
-            font = ImageFont.load_default()
-        params = {"image_width": 600, "sidebar_width": 60, "gap": 25 if layout_params.get('style') == "保留间隙" else 0}
-        current_y = 0
-        for i, original_img in enumerate(original_images):
-            ratio = params["image_width"] / original_img.width
-            img_height = int(original_img.height * ratio)
-            text = texts[i] if i < len(texts) else ""
-            text_area_width = params["image_width"] - 40
-            wrapped_lines = wrap_text(draw, text, text_area_width, font)
-            total_text_height = len(wrapped_lines) * font_size
-            start_y = current_y + img_height - total_text_height - 20
-            for line in wrapped_lines:
-                line_x = params["sidebar_width"] + 20
-                draw.text((line_x, start_y), line, font=font, fill=(240, 240, 240), stroke_width=1,
-                          stroke_fill=(0, 0, 0))
-                start_y += font_size
-            current_y += img_height + params["gap"]
+            current_y += font_size * 1.2
+
+    elif geometry.layout_style == "电影竖排":
+        for x, y, line in get_film_strip_text_lines(draw, texts, geometry, font):
+            draw_film_strip_text_line(draw, (x, y), line, font)
 
     return image
 
 
-def wrap_text(draw, text, width, font):
+def get_film_strip_text_lines(draw, texts, geometry, font):
+    """
+    计算电影竖排中每一行文字的位置，返回 [(x, y, 行文字), ...]（画布坐标，均为整数）。
+    分段写出长胶卷时，每一段只需画落在本段范围内的那些行。
+    """
+    text_lines = []
+    for i, (x0, _, x1, y1) in enumerate(geometry.text_regions):
+        text = texts[i] if i < len(texts) else ""
+        wrapped_lines = wrap_text(draw, text, x1 - x0, font)
+        # 整段文字的底部对齐到文字区域底部
+        start_y = y1 - len(wrapped_lines) * geometry.font_size
+        for line in wrapped_lines:
+            text_lines.append((x0, start_y, line))
+            start_y += geometry.font_size
+    return text_lines
+
+
+def draw_film_strip_text_line(draw, position, line, font):
+    draw.text(position, line, font=font, fill=(240, 240, 240), stroke_width=1, stroke_fill=(0, 0, 0))
+
+
+GLYPH_CACHE_FONTS = 32  # 最多为多少个字体保存字符宽度缓存
+_glyph_advances = OrderedDict()  # 字体键 -> {字符: 前进宽度}，越靠后越是最近使用
+
+
+def get_glyph_advances(font):
+    """
+    返回该字体（含字号）的字符宽度缓存字典，按最近使用淘汰。
+    从内存加载的字体（比如默认字体）没有文件路径，用对象本身的 id 区分。
+    """
+    path = getattr(font, "path", None)
+    key = (path if isinstance(path, str) else id(font), getattr(font, "size", None), getattr(font, "index", 0))
+    advances = _glyph_advances.get(key)
+    if advances is None:
+        advances = _glyph_advances[key] = {}
+        if len(_glyph_advances) > GLYPH_CACHE_FONTS:
+            _glyph_advances.popitem(last=False)
+    else:
+        _glyph_advances.move_to_end(key)
+    return advances
+
+
+def is_cjk(char):
+    """中日韩文字和全角标点，它们之间的任意位置都可以换行"""
+    code = ord(char)
+    return (0x2E80 <= code <= 0x9FFF or 0xAC00 <= code <= 0xD7AF
+            or 0xF900 <= code <= 0xFAFF or 0xFF00 <= code <= 0xFFEF)
+
+
+def _is_word_char(char):
+    return not char.isspace() and not is_cjk(char)
+
+
+def wrap_text(draw, text, width, font, break_words=True):
     """
     【中文优化版】
     一个辅助函数，用于将长文本（包括中文）换行。
+    先用缓存的单字宽度估计每行能放下多少字，再用 textbbox 精确校正断点，
+    每行只需测量几次，而不是每加一个字就把整行重新测量一遍；结果与逐字测量完全一致。
+    break_words 为 False 时，不在英文单词中间断行，而是退回到上一个空格（中文仍可在任意位置断行）。
     """
     lines = []
     if not text:
         return lines
 
-    current_line = ""
-    for char in text:
-        # 检查加上新字符后是否会超宽
-        if draw.textbbox((0, 0), current_line + char, font=font)[2] <= width:
-            current_line += char
-        else:
-            lines.append(current_line)
-            current_line = char
-    lines.append(current_line)
+    advances = get_glyph_advances(font)
+
+    def fits(line):
+        return draw.textbbox((0, 0), line, font=font)[2] <= width
+
+    start = 0
+    min_chars = 0  # 第一行的第一个字也要检查宽度；之后每行的第一个字总是直接放入（与逐字换行一致）
+    while start < len(text):
+        # 1. 按单字宽度累加，估计这一行的结束位置
+        end = start
+        line_width = 0
+        while end < len(text):
+            char = text[end]
+            advance = advances.get(char)
+            if advance is None:
+                advance = advances[char] = font.getlength(char)
+            if line_width + advance > width:
+                break
+            line_width += advance
+            end += 1
+        end = max(end, start + min_chars)
+
+        # 2. 精确校正：估计偏多时逐字回退，估计偏少时逐字前进
+        while end > start + min_chars and not fits(text[start:end]):
+            end -= 1
+        while end < len(text) and fits(text[start:end + 1]):
+            end += 1
+
+        # 3. 按需避免把英文单词断开
+        if not break_words and start < end < len(text) and _is_word_char(text[end - 1]) and _is_word_char(text[end]):
+            space = text.rfind(" ", start, end)
+            if space > start:
+                end = space
+
+        start, line = end, text[start:end]
+        min_chars = 1
+        if not break_words:
+            line = line.rstrip(" ")
+            while start < len(text) and text[start] == " ":
+                start += 1  # 新的一行不以空格开头
+        lines.append(line)
 
     return lines
@@ -196,7 +196,9 @@
 # file: main.py
 
 from app_ui import PhotoBoothApp # 从我们的UI文件，导入应用主类
+import tracing
 
 if __name__ == "__main__":
+    tracing.configure_from_env()  # 设置了 COLLAGE_TRACE 时把各阶段计时写入该文件
     app = PhotoBoothApp() # 实例化应用
     app.mainloop()      # 运行应用
\ No newline at end of file
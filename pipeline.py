@@ -0,0 +1,329 @@
+# file: pipeline.py
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+import ai_connector
+import font_registry
+import layouts
+import lut_engine
+import png_stream
+import tracing
+
+STAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 阶段缓存的默认内存上限（按图片像素数据估算）
+
+
+class RenderCancelled(Exception):
+    """渲染在检查点被取消（should_cancel 返回 True）。被取消的阶段不会写入缓存"""
+
+
+def check_cancelled(should_cancel):
+    """检查点：should_cancel 为可选的无参函数，返回 True 时抛出 RenderCancelled"""
+    if should_cancel is not None and should_cancel():
+        raise RenderCancelled()
+
+
+class StageCache:
+    """
+    【阶段结果缓存】按内存占用（估算的字节数）限制大小的LRU缓存。
+    每个阶段的结果以“该阶段全部输入”为键保存，只改了靠后的选项（比如字体）时，
+    前面的解码、滤镜、布局都直接复用，只重新计算之后的阶段。可以在多个线程中共用。
+    """
+
+    def __init__(self, max_bytes=STAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # 键 -> (结果, 估算字节数)，越靠后越是最近使用
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """取出缓存的结果，未命中时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        """保存结果，超出内存上限时淘汰最久未使用的条目；单个结果比上限还大时不保存"""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+def estimate_size(value):
+    """粗略估算结果占用的内存：图片按像素数据计算，其他对象只按很小的固定值计算"""
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(estimate_size(item) for item in value)
+    if isinstance(value, str):
+        return 64 + len(value.encode("utf-8"))
+    return 64
+
+
+def get_source_key(image_paths):
+    """图片路径连同修改时间和大小一起作为输入的标识，文件被替换后缓存自动失效"""
+    source_key = []
+    for path in image_paths:
+        stat = os.stat(path)
+        source_key.append((os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(source_key)
+
+
+def get_filter_key(filter_name):
+    """
+    滤镜阶段缓存键中的滤镜部分：配方中每个 .cube 文件的 (路径, 修改时间, 大小, 强度)（见 lut_engine.get_recipe_key），
+    文件被替换后自动失效。“无”、文件不存在或配方写错时为名称本身（apply_filter 此时原样返回图片）。
+    """
+    if filter_name == "无":
+        return filter_name
+    try:
+        return lut_engine.get_recipe_key(filter_name)
+    except (OSError, ValueError):
+        return filter_name
+
+
+def get_proxy_scale(image_paths, layout_style, style, view_size):
+    """
+    计算预览代理图的缩放比例：让整张成品刚好放进 view_size (宽, 高)，不放大。
+    只读取图片文件头，不解码像素。
+    """
+    view_width, view_height = view_size
+    if view_width <= 1 or view_height <= 1:
+        return 1.0
+    photo_sizes = [layouts.resolve_target_size(layouts.read_image_size(path), layout_style) for path in image_paths]
+    if layout_style == "单张海报":
+        photo_sizes = photo_sizes[:1]
+    width, height = layouts.build_layout_geometry(photo_sizes, layout_style, style).canvas_size
+    return min(1.0, view_width / width, view_height / height)
+
+
+def run_stage(cache, key, compute, on_compute=None):
+    """
+    命中缓存时直接返回结果；否则调用 compute 计算并写入缓存（cache 为 None 时不使用缓存）。
+    实际计算的阶段以键的第一项（"decode"、"filter" 等）为名记录一个计时 span。
+    """
+    if cache is not None:
+        value = cache.get(key)
+        if value is not None:
+            return value
+    if on_compute:
+        on_compute()
+    with tracing.span(key[0]):
+        value = compute()
+    if cache is not None:
+        cache.put(key, value)
+    return value
+
+
+def render_collage(image_paths, layout_style, style="保留间隙", filter_name="无", font_name="默认",
+                   content_style="简体短句", grade_at_source=False, texts=None, use_ai=True, use_ai_cache=True,
+                   ai_separate_frames=False, on_status=None, cache=None, scale=1.0, on_texts=None,
+                   should_cancel=None, backend=lut_engine.DEFAULT_BACKEND):
+    """
+    【完整渲染流程】解码 → 滤镜 → 布局 → AI赋文 → 绘制文字，返回最终的Pillow图片。
+    界面和无界面的批处理共用这一流程，本模块不依赖任何界面库。
+
+    texts 不为 None 时直接使用给定文字，不再请求AI；use_ai 为 False 且没有给定文字时不绘制文字。
+    use_ai_cache 为 False 时不读写AI文字缓存，总是重新请求。
+    ai_separate_frames 为 True 时，把每一帧照片单独发送给AI，而不是发送整张拼接图。
+    on_status 是可选的回调函数，每进入一个阶段就会以状态文字调用一次。
+    cache 为 StageCache 时，各阶段的结果按输入缓存，只重新计算输入发生变化的阶段。
+    scale 小于1时整条流程都在预览分辨率上进行（见 get_proxy_scale），此时忽略 grade_at_source；
+    成品与预览的几何关系一致，只是所有尺寸按同一比例缩放；需要请求AI时，发给AI的图片仍按成品分辨率合成。
+    on_texts 是可选的回调函数，确定要绘制的文字后以文字列表调用一次，
+    界面据此在导出全分辨率成品时复用预览中的文字，不必再请求AI。
+    should_cancel 是可选的无参函数，在每个阶段之间（以及逐张处理图片时）检查，
+    返回 True 时抛出 RenderCancelled，让已经过时的渲染尽早停下。
+    backend 为滤镜后端（见 lut_engine.FILTER_BACKENDS），不同后端的结果分别缓存。
+    """
+    def report(message):
+        if on_status:
+            on_status(message)
+
+    images, filtered_images, (composed_image, geometry), layout_key = _compose(
+        image_paths, layout_style, style, filter_name, grade_at_source, report, cache, scale, should_cancel, backend)
+
+    if texts is None and use_ai:
+        # 4. 把带边框但不带文字的图发给AI；请求失败的结果不缓存，下次重新请求。
+        # 文字只取决于照片、排版和内容风格：修改间隙样式、滤镜、强度、字体或窗口大小都不会再请求AI
+        ai_key = ("ai", get_source_key(image_paths), layout_style, content_style, ai_separate_frames)
+        stage_cache = cache if use_ai_cache else None
+        if stage_cache is not None:
+            texts = stage_cache.get(ai_key)
+        if texts is None:
+            ai_image, ai_frames = composed_image, filtered_images
+            if scale != 1:
+                # 预览代理图太小，AI 看不清细节：按成品分辨率合成一份（结果会缓存，保存时直接复用），
+                # 发送前由 ai_connector 按负载预算缩小
+                _, ai_frames, (ai_image, _), _ = _compose(
+                    image_paths, layout_style, style, filter_name, grade_at_source, report, cache, 1.0, should_cancel,
+                    backend)
+            check_cancelled(should_cancel)
+            report("正在请求AI生成文字...")
+            texts = ai_connector.get_ai_text(ai_image, content_style, len(geometry.frames),
+                                             use_cache=use_ai_cache, frames=ai_frames if ai_separate_frames else None)
+            if stage_cache is not None and not ai_connector.is_failed_result(texts):
+                stage_cache.put(ai_key, texts)
+
+    if texts is None:
+        return composed_image
+    check_cancelled(should_cancel)
+    if on_texts:
+        on_texts(texts)
+
+    # 5. 最后在图上绘制文字。绘制会直接修改图片，所以在布局图的副本上进行，缓存中的布局图保持不变
+    text_key = ("text", layout_key, tuple(texts), font_registry.get_font_file_key(font_name))
+    return run_stage(cache, text_key, lambda: layouts.draw_text_on_image(
+        image=composed_image.copy(),
+        texts=texts,
+        geometry=geometry,
+        font_name=font_name
+    ), on_compute=lambda: report("正在绘制文字..."))
+
+
+def compose_collage(image_paths, layout_style, style="保留间隙", filter_name="无", grade_at_source=False,
+                    on_status=None, cache=None, scale=1.0, should_cancel=None, backend=lut_engine.DEFAULT_BACKEND):
+    """
+    【不含文字的前半段流程】解码 → 滤镜 → 布局。
+    返回 (解码后的图片, 调色后的图片, 拼好的不带文字的布局图, 布局几何)，
+    布局几何可以直接交给 layouts.draw_text_on_image 在布局图上绘制文字。
+    """
+    def report(message):
+        if on_status:
+            on_status(message)
+
+    images, filtered_images, (composed_image, geometry), _ = _compose(
+        image_paths, layout_style, style, filter_name, grade_at_source, report, cache, scale, should_cancel, backend)
+    return images, filtered_images, composed_image, geometry
+
+
+def _compose(image_paths, layout_style, style, filter_name, grade_at_source, report, cache, scale=1.0,
+             should_cancel=None, backend=lut_engine.DEFAULT_BACKEND):
+    """
+    前半段流程的实现，返回 (解码后的图片, 调色后的图片, (布局图, 布局几何), 布局阶段的缓存键)，
+    缓存键供后续阶段组成自己的键。
+    """
+    if scale != 1:
+        grade_at_source = False  # 预览代理图总是先缩小再调色
+
+    # 1. 按布局所需的分辨率解码；在原图分辨率上调色时则完整解码
+    load_layout = None if grade_at_source else layout_style
+    decode_key = ("decode", get_source_key(image_paths), load_layout, scale)
+    def decode_images():
+        images = []
+        for path in image_paths:
+            check_cancelled(should_cancel)
+            images.append(layouts.load_image(path, load_layout, scale))
+        return images
+
+    check_cancelled(should_cancel)
+    images = run_stage(cache, decode_key, decode_images, on_compute=lambda: report("图片处理中..."))
+
+    # 2. 默认只对缩放后的图片调色；grade_at_source 为 True 时保持旧行为，直接处理原图
+    def apply_filters():
+        if grade_at_source:
+            images_to_filter = images
+        elif scale != 1:
+            # 代理图已经按比例解码到布局中的尺寸，不能再按原图规则缩放一次
+            images_to_filter = images[:1] if layout_style == "单张海报" else images
+        else:
+            images_to_filter = layouts.fit_images_to_layout(images, layout_style)
+        filtered_images = []
+        for img in images_to_filter:
+            check_cancelled(should_cancel)
+            filtered_images.append(layouts.apply_filter(img, filter_name, backend))
+        return filtered_images
+
+    check_cancelled(should_cancel)
+    filter_key = ("filter", decode_key, layout_style, get_filter_key(filter_name), backend)
+    filtered_images = run_stage(cache, filter_key, apply_filters, on_compute=lambda: report("滤镜应用中..."))
+
+    # 3. 然后用处理过的图片去创建布局，同时得到供文字绘制使用的布局几何
+    def create_layout():
+        if layout_style == "电影竖排":
+            return layouts.create_film_strip_layout(filtered_images, style=style, scale=scale)
+        else:  # 单张海报
+            return layouts.create_poster_layout(filtered_images, scale=scale)
+
+    check_cancelled(should_cancel)
+    layout_key = ("layout", filter_key, style)
+    layout = run_stage(cache, layout_key, create_layout, on_compute=lambda: report("正在生成布局..."))
+    return images, filtered_images, layout, layout_key
+
+
+def stream_film_strip(image_paths, output_path, style="保留间隙", filter_name="无", font_name="默认", texts=None,
+                      on_status=None, should_cancel=None, compression_level=png_stream.COMPRESSION_LEVEL,
+                      backend=lut_engine.DEFAULT_BACKEND):
+    """
+    【分段流式输出的电影竖排】一帧一帧地解码、调色、缩放，拼成一段后立即压缩写入PNG文件。
+    内存中最多只有一帧（连同它下方的间隙），几百帧的整卷胶片也不会占满内存。
+    结果与 render_collage 生成的电影竖排逐像素一致；texts 为 None 时不绘制文字（这里不请求AI）。
+    每一帧开始前检查 should_cancel，被取消时不会留下写了一半的文件。
+    compression_level 为 zlib 压缩级别（0-9），越高文件越小、编码越慢。backend 为滤镜后端。
+    """
+    def report(message):
+        if on_status:
+            on_status(message)
+
+    # 1. 只读取文件头，就能算出整条胶卷的布局几何
+    photo_sizes = [layouts.resolve_target_size(layouts.read_image_size(path), "电影竖排") for path in image_paths]
+    geometry = layouts.build_layout_geometry(photo_sizes, "电影竖排", style)
+    width, height = geometry.canvas_size
+    sidebar_width = layouts.FILM_STRIP_SIDEBAR_WIDTH
+    right_sidebar_x = sidebar_width + layouts.FILM_STRIP_IMAGE_WIDTH
+
+    # 2. 文字的位置也预先全部算好，每一段只画落在本段内的行
+    text_lines = []
+    if texts is not None:
+        font = font_registry.get_named_font(font_name, geometry.font_size)
+        measure_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+        text_lines = layouts.get_film_strip_text_lines(measure_draw, texts or layouts.FALLBACK_TEXTS, geometry, font)
+
+    # 3. 每一段从这一帧的顶部到下一帧的顶部（包含中间的间隙），按顺序写出
+    with tracing.span("save", format="png-stream", frames=len(image_paths), height=height), \
+            png_stream.StreamingPNGWriter(output_path, width, height, compression_level) as writer:
+        for i, (path, frame) in enumerate(zip(image_paths, geometry.frames)):
+            check_cancelled(should_cancel)
+            report(f"正在处理第 {i + 1}/{len(image_paths)} 帧...")
+            top = frame[1]
+            bottom = geometry.frames[i + 1][1] if i + 1 < len(geometry.frames) else height
+
+            band = Image.new("RGB", (width, bottom - top), "black")
+            with tracing.span("decode"):
+                photo = layouts.load_image(path, "电影竖排")
+            with tracing.span("filter"):
+                photo = layouts.apply_filter(photo, filter_name, backend)
+            band.paste(photo, (frame[0], 0))
+
+            column, offset = layouts.get_sprocket_band(top, bottom - top, sidebar_width, layouts.FILM_STRIP_HOLE_SIZE)
+            band.paste(column, (0, -offset))
+            band.paste(column, (right_sidebar_x, -offset))
+
+            if text_lines:
+                draw = ImageDraw.Draw(band)
+                for x, y, line in text_lines:
+                    # 描边和字形可能略微超出字号范围，多留一行的余量，超出本段的部分会被自动裁掉
+                    if top - geometry.font_size * 2 < y < bottom + geometry.font_size:
+                        layouts.draw_film_strip_text_line(draw, (x, y - top), line, font)
+
+            writer.write_rows(band)
+
+    return output_path
@@ -0,0 +1,120 @@
+# file: png_stream.py
+import os
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_FILTER_PAETH = 4
+IDAT_CHUNK_BYTES = 1 << 20    # 压缩数据攒够这么多再写出一个 IDAT 块
+COMPRESSION_LEVEL = 6
+
+
+class StreamingPNGWriter:
+    """
+    【流式PNG写入】按从上到下的顺序一段一段（若干行）写入RGB图片，
+    内存中只保留当前这一段和压缩器的状态，整张图片从不需要完整地放在内存里。
+
+    用法:
+        with StreamingPNGWriter(path, width, height) as writer:
+            writer.write_rows(band)  # band 为 Pillow RGB 图片或 (行数, width, 3) 的 uint8 数组
+    所有行写完后正常退出 with 块才会生成文件；中途出错时不会留下写了一半的文件。
+    """
+
+    def __init__(self, path, width, height, compression_level=COMPRESSION_LEVEL):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compression_level)
+        self._pending = []          # 还没写出的压缩数据
+        self._pending_bytes = 0
+        self._previous_row = np.zeros((1, width, 3), dtype=np.uint8)  # Paeth 滤波需要上一行
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(PNG_SIGNATURE)
+        # 8位深度、RGB、标准压缩和滤波方式、不隔行
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                if os.path.exists(self._tmp_path):
+                    os.remove(self._tmp_path)  # 出错时删除半成品
+        return False
+
+    def write_rows(self, band):
+        """写入紧接着上一次的若干行"""
+        rows = np.asarray(band, dtype=np.uint8)
+        if rows.ndim != 3 or rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"每一段必须是 {self.width} 像素宽的RGB图片，收到的形状为 {rows.shape}")
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("写入的行数超过了图片高度")
+
+        filtered = _paeth_filter(rows, self._previous_row)
+        self._previous_row = rows[-1:].copy()
+        self.rows_written += len(rows)
+        self._add_compressed(self._compressor.compress(filtered.tobytes()))
+
+    def close(self):
+        """写出剩余数据和文件尾，再把临时文件改名为目标文件"""
+        if self.rows_written != self.height:
+            raise ValueError(f"只写入了 {self.rows_written} 行，图片高度为 {self.height}")
+        self._add_compressed(self._compressor.flush(), flush=True)
+        self._write_chunk(b"IEND", b"")
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+
+    def _add_compressed(self, data, flush=False):
+        if data:
+            self._pending.append(data)
+            self._pending_bytes += len(data)
+        if self._pending_bytes >= IDAT_CHUNK_BYTES or (flush and self._pending):
+            self._write_chunk(b"IDAT", b"".join(self._pending))
+            self._pending.clear()
+            self._pending_bytes = 0
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+
+def _paeth_filter(rows, previous_row):
+    """
+    对每一行做 PNG 的 Paeth 滤波（滤波类型4），返回每行开头带滤波类型字节的数据。
+    滤波只用到原始像素（左、上、左上），所以可以整段一次性用 NumPy 计算。
+    """
+    height, width, _ = rows.shape
+    current = rows.reshape(height, width * 3).astype(np.int16)
+    above = np.concatenate([previous_row.reshape(1, width * 3), rows[:-1].reshape(height - 1, width * 3)])
+    above = above.astype(np.int16)
+
+    left = np.zeros_like(current)
+    left[:, 3:] = current[:, :-3]
+    upper_left = np.zeros_like(above)
+    upper_left[:, 3:] = above[:, :-3]
+
+    estimate = left + above - upper_left
+    distance_left = np.abs(estimate - left)
+    distance_above = np.abs(estimate - above)
+    distance_upper_left = np.abs(estimate - upper_left)
+    predictor = np.where((distance_left <= distance_above) & (distance_left <= distance_upper_left), left,
+                         np.where(distance_above <= distance_upper_left, above, upper_left))
+
+    filtered = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    filtered[:, 0] = PNG_FILTER_PAETH
+    filtered[:, 1:] = (current - predictor) & 0xFF  # 按字节取模256
+    return filtered
@@ -0,0 +1,89 @@
+# file: render_executor.py
+import itertools
+import queue
+import threading
+
+from pipeline import RenderCancelled
+
+
+class RenderJob:
+    """
+    一个等待执行或正在执行的渲染任务。
+    任务函数通过 report 汇报进度，通过 is_cancelled / check_cancelled 在各阶段之间检查是否已被取消。
+    """
+
+    def __init__(self, job_id, group, func, events):
+        self.id = job_id
+        self.group = group
+        self.func = func
+        self._events = events
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        """已被取消时抛出 RenderCancelled，在任务函数中的检查点调用"""
+        if self._cancelled.is_set():
+            raise RenderCancelled()
+
+    def report(self, message):
+        """汇报进度文字（线程安全，由界面线程从事件队列中取出显示）"""
+        self._events.put((self, "status", message))
+
+
+class RenderExecutor:
+    """
+    【单线程渲染执行器】所有渲染任务都排进同一个队列，由唯一的后台线程依次执行，
+    不会有多个渲染同时抢占CPU。同一分组（比如“预览”）提交新任务时，队列中和正在执行的旧任务会被取消：
+    排队的旧任务直接跳过，正在执行的旧任务在下一个检查点停下。
+
+    后台线程从不直接操作界面，所有进度和结果都放进线程安全的 events 队列，
+    格式为 (任务, 类型, 内容)，类型为 "status"、"done"、"error" 或 "cancelled"，
+    由界面线程用 after 定时取出处理。
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self._jobs = queue.Queue()
+        self._job_ids = itertools.count(1)
+        self._active = {}  # 分组 -> 该分组最近提交的任务
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="render-executor", daemon=True)
+        self._worker.start()
+
+    def submit(self, func, group, supersede=True):
+        """
+        提交任务，func 在后台线程中以 func(job) 的形式调用，返回值作为 "done" 事件的内容。
+        supersede 为 True 时，同一分组中尚未完成的旧任务全部取消。返回 RenderJob。
+        """
+        with self._lock:
+            job = RenderJob(next(self._job_ids), group, func, self.events)
+            previous = self._active.get(group)
+            if supersede and previous is not None:
+                previous.cancel()
+            self._active[group] = job
+        self._jobs.put(job)
+        return job
+
+    def is_current(self, job):
+        """任务是否仍是其分组中最新提交的那一个（旧任务的结果应该丢弃）"""
+        with self._lock:
+            return self._active.get(job.group) is job
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job.is_cancelled():
+                continue  # 排队期间已经被新任务取代，直接跳过
+            try:
+                result = job.func(job)
+            except RenderCancelled:
+                self.events.put((job, "cancelled", None))
+            except Exception as e:
+                self.events.put((job, "error", e))
+            else:
+                self.events.put((job, "done", result))
@@ -0,0 +1,148 @@
+# file: shm_pool.py
+import sys
+from collections import namedtuple
+from concurrent.futures import FIRST_EXCEPTION, wait
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image
+
+import layouts
+import lut_engine
+import tracing
+
+# 跨进程传递的只有共享内存的名称和数组形状，像素数据从不经过 pickle
+SharedImageHandle = namedtuple("SharedImageHandle", ["name", "shape"])
+
+
+class SharedImageBuffer:
+    """
+    【共享内存中的RGB图片】一块 multiprocessing.shared_memory，按 (高, 宽, 3) 的 uint8 数组使用。
+    创建者（主进程）负责释放：用完后 close 并 unlink；其他进程用 attach 打开，只 close、不 unlink。
+    通过 array 取得的 NumPy 视图必须在 close 之前全部释放，否则共享内存无法关闭。
+
+    用法:
+        with SharedImageBuffer.create((height, width, 3)) as canvas:
+            executor.submit(worker, canvas.handle, ...)   # 工作进程中: SharedImageBuffer.attach(handle)
+            image = canvas.to_image()
+    """
+
+    def __init__(self, shm, shape, owner):
+        self._shm = shm
+        self.shape = tuple(shape)
+        self.owner = owner
+
+    @classmethod
+    def create(cls, shape):
+        """新建共享内存。操作系统分配的共享内存初始全为0，正好是黑色背景"""
+        size = int(np.prod(shape))
+        return cls(shared_memory.SharedMemory(create=True, size=max(1, size)), shape, owner=True)
+
+    @classmethod
+    def attach(cls, handle):
+        """在工作进程中打开主进程创建的共享内存"""
+        return cls(_attach_untracked(handle.name), handle.shape, owner=False)
+
+    @property
+    def handle(self):
+        return SharedImageHandle(self._shm.name, self.shape)
+
+    @property
+    def array(self):
+        """直接指向共享内存的数组视图，写入立即对所有进程可见"""
+        return np.ndarray(self.shape, dtype=np.uint8, buffer=self._shm.buf)
+
+    def to_image(self):
+        """复制出一张普通的Pillow图片（Pillow 的RGB图片不能直接建立在外部内存上）"""
+        return Image.fromarray(self.array)
+
+    def close(self):
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _attach_untracked(name):
+    """
+    打开已有的共享内存，但不登记到 resource_tracker。
+    共享内存的生命周期由创建它的主进程负责；如果工作进程也登记，工作进程退出时它的 resource_tracker
+    会把仍在使用的共享内存删掉并报告“泄漏”。Python 3.13 起可以直接传 track=False；
+    更早的版本在打开期间临时跳过登记（工作进程是单线程的，不会影响其他代码）。
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _render_frame_into(handle, path, filter_name, frame, backend):
+    """在工作进程中解码、调色一帧，直接写入共享画布中这一帧的位置"""
+    with tracing.span("decode"):
+        photo = layouts.load_image(path, "电影竖排")
+    with tracing.span("filter"):
+        photo = layouts.apply_filter(photo, filter_name, backend)
+    x0, y0, x1, y1 = frame
+    if photo.size != (x1 - x0, y1 - y0):
+        raise ValueError(f"{path} 解码后的尺寸 {photo.size} 与布局中的 {(x1 - x0, y1 - y0)} 不一致")
+    with SharedImageBuffer.attach(handle) as canvas:
+        canvas.array[y0:y1, x0:x1] = np.asarray(photo.convert("RGB"))
+
+
+def render_film_strip(executor, image_paths, style="保留间隙", filter_name="无", font_name="默认", texts=None,
+                      on_status=None, backend=lut_engine.DEFAULT_BACKEND):
+    """
+    【多进程电影竖排】主进程只读取文件头算出布局几何，在共享内存中分配整张画布；
+    每一帧交给进程池中的一个工作进程解码、调色后直接写进画布，进程之间只传递共享内存的名称和帧的位置。
+    全部帧完成后，主进程贴上齿孔边栏、绘制文字，返回与 render_collage 逐像素一致的Pillow图片。
+    texts 为 None 时不绘制文字（这里不请求AI）。共享内存在返回或出错时都会被释放。
+    """
+    def report(message):
+        if on_status:
+            on_status(message)
+
+    # 1. 只读取文件头，算出整条胶卷的布局几何
+    photo_sizes = [layouts.resolve_target_size(layouts.read_image_size(path), "电影竖排") for path in image_paths]
+    geometry = layouts.build_layout_geometry(photo_sizes, "电影竖排", style)
+    width, height = geometry.canvas_size
+
+    with SharedImageBuffer.create((height, width, 3)) as canvas:
+        # 2. 各帧并行解码、调色，直接写入共享画布
+        report(f"正在并行处理 {len(image_paths)} 帧...")
+        futures = [executor.submit(_render_frame_into, canvas.handle, path, filter_name, frame, backend)
+                   for path, frame in zip(image_paths, geometry.frames)]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        wait(not_done)  # 已经开始的帧要等它们写完，才能释放共享内存
+        for future in done:
+            future.result()  # 有帧失败时在这里抛出它的异常
+
+        # 3. 贴上两侧的齿孔边栏
+        sidebar_width = layouts.FILM_STRIP_SIDEBAR_WIDTH
+        column = np.asarray(layouts.get_sprocket_column(height, sidebar_width, layouts.FILM_STRIP_HOLE_SIZE))
+        pixels = canvas.array
+        pixels[:, :sidebar_width] = column[:height]
+        pixels[:, width - sidebar_width:] = column[:height]
+        del pixels  # 释放视图，否则共享内存无法关闭
+
+        # 4. 复制出普通图片后绘制文字
+        image = canvas.to_image()
+
+    if texts is not None:
+        report("正在绘制文字...")
+        layouts.draw_text_on_image(image, texts, geometry, font_name)
+    return image
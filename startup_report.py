@@ -0,0 +1,70 @@
+# file: startup_report.py
+"""
+启动耗时报告：用 `python -X importtime` 在全新的子进程中导入指定模块，
+汇总总耗时，并列出累计耗时最多的导入项，方便发现拖慢启动的重量级依赖。
+
+用法示例:
+    python startup_report.py                 # 默认检查 app_ui、batch、layouts、ai_connector
+    python startup_report.py layouts --top 20
+"""
+import argparse
+import subprocess
+import sys
+
+DEFAULT_MODULES = ["app_ui", "batch", "layouts", "ai_connector"]
+
+
+def measure_imports(module_name):
+    """
+    在子进程中导入模块，返回导入记录列表 [(包名, 自身耗时us, 累计耗时us, 嵌套深度), ...]。
+    每个模块都使用全新的解释器，互不影响缓存。
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        capture_output=True, text=True, encoding="utf-8", errors="replace",
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module_name} 失败:\n{result.stderr.strip()}")
+
+    records = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        records.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return records
+
+
+def print_report(module_name, records, top):
+    # 目标模块本身是最后一条、深度为0的记录，它的累计耗时就是总导入耗时
+    total_us = next((cumulative for name, _, cumulative, depth in reversed(records)
+                     if depth == 0 and name == module_name), 0)
+    print(f"=== {module_name}: 总导入耗时 {total_us / 1000:.1f} ms，共导入 {len(records)} 个模块 ===")
+
+    # 只看第三方包和项目模块的顶层包，子模块的耗时已经包含在顶层包的累计耗时里
+    top_level = {}
+    for name, _, cumulative, _ in records:
+        package = name.split(".")[0]
+        if name == package:
+            top_level[package] = max(top_level.get(package, 0), cumulative)
+
+    ranked = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:top]
+    for package, cumulative in ranked:
+        share = cumulative / total_us * 100 if total_us else 0
+        print(f"  {cumulative / 1000:9.1f} ms  {share:5.1f}%  {package}")
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="统计各模块的导入（冷启动）耗时")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="要检查的模块名")
+    parser.add_argument("--top", type=int, default=10, help="列出累计耗时最多的前N个包（默认: 10）")
+    args = parser.parse_args(argv)
+
+    for module_name in args.modules:
+        print_report(module_name, measure_imports(module_name), args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# file: tracing.py
+"""
+轻量的分阶段计时：用 span 包住一段代码，记录墙钟时间、本线程的CPU时间和进程内存（RSS）的变化。
+
+    with tracing.span("filter", filter_name="ColdChrome") as s:
+        ...
+        s.set(frames=3)            # 可以在结束前补充属性
+
+没有启用输出、也没有 capture 时，span 直接返回一个什么都不做的共享对象，开销只有一次函数调用。
+
+输出方式（通过 enable 或环境变量 COLLAGE_TRACE 设置路径）:
+    *.json      Chrome 跟踪格式，可直接拖进 chrome://tracing 或 https://ui.perfetto.dev 查看
+    其他扩展名  每个 span 一行 JSON（JSON lines），便于 grep / jq 分析
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+TRACE_ENV_VAR = "COLLAGE_TRACE"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# 界面中显示的阶段名称，未列出的阶段显示原名
+STAGE_LABELS = {
+    "decode": "解码",
+    "filter": "滤镜",
+    "layout": "布局",
+    "ai_request": "AI",
+    "text": "文字",
+    "canvas_redraw": "重绘",
+    "save": "保存",
+}
+
+_sink = None            # 当前的输出文件（_TraceSink），为 None 时不写文件
+_capture_count = 0      # 正在进行的 capture 数量；与 _sink 都为空时 span 不做任何事
+_state_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    """未启用时返回的空 span"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """补充属性，比如在请求完成后记录负载字节数"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = _get_stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self._rss = _current_rss()
+        self._alloc = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self._cpu = time.thread_time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._start
+        cpu = time.thread_time() - self._cpu
+        _get_stack().pop()
+
+        record = {
+            "name": self.name,
+            "start": self._start,
+            "wall_ms": wall * 1000,
+            "cpu_ms": cpu * 1000,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "tid": threading.get_ident(),
+            "parent": self.parent,
+        }
+        rss = _current_rss()
+        if rss is not None and self._rss is not None:
+            record["rss_delta_mb"] = (rss - self._rss) / 1024 / 1024
+        if self._alloc is not None and tracemalloc.is_tracing():
+            record["alloc_delta_mb"] = (tracemalloc.get_traced_memory()[0] - self._alloc) / 1024 / 1024
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        if self.attrs:
+            record["attrs"] = self.attrs
+        _emit(record)
+        return False
+
+
+def span(name, **attrs):
+    """计时一段代码，返回上下文管理器；未启用时几乎没有开销"""
+    if _sink is None and not _capture_count:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def is_enabled():
+    return _sink is not None
+
+
+def enable(path, per_process=False):
+    """
+    开始把 span 写入 path，返回实际写入的路径。per_process 为 True 且输出 Chrome 跟踪格式时，
+    在文件名中加入进程号，供多进程批处理使用（Chrome 跟踪文件不能由多个进程同时写，JSON lines 可以）。
+    """
+    global _sink
+    if per_process and _is_chrome_path(path):
+        stem, ext = os.path.splitext(path)
+        path = f"{stem}.{os.getpid()}{ext}"
+    with _state_lock:
+        if _sink is not None:
+            _sink.close()
+        _sink = _TraceSink(path)
+    atexit.register(disable)  # 进程退出时补全文件；多次注册也没关系，disable 可以重复调用
+    return path
+
+
+def disable():
+    """停止输出，并把文件补充完整"""
+    global _sink
+    with _state_lock:
+        if _sink is not None:
+            _sink.close()
+            _sink = None
+
+
+def configure_from_env(per_process=False):
+    """设置了环境变量 COLLAGE_TRACE 时按它的路径启用输出，返回实际使用的路径（未设置时为 None）"""
+    path = os.getenv(TRACE_ENV_VAR)
+    if not path:
+        return None
+    return enable(path, per_process=per_process)
+
+
+@contextmanager
+def capture():
+    """
+    收集本线程在 with 块中完成的所有 span（即使没有启用文件输出），
+    with 返回的列表在块结束后包含这些记录，界面据此显示各阶段耗时。
+    """
+    global _capture_count
+    records = []
+    captures = _get_captures()
+    captures.append(records)
+    with _state_lock:
+        _capture_count += 1
+    try:
+        yield records
+    finally:
+        captures.remove(records)
+        with _state_lock:
+            _capture_count -= 1
+
+
+def summarize(records, top_level_only=True):
+    """把记录汇总成一行文字，比如“解码 120ms · 滤镜 35ms · 布局 8ms”，同名阶段累加"""
+    totals = {}
+    for record in records:
+        if top_level_only and record["parent"] is not None:
+            continue
+        totals[record["name"]] = totals.get(record["name"], 0) + record["wall_ms"]
+    return " · ".join(f"{STAGE_LABELS.get(name, name)} {ms:.0f}ms" for name, ms in totals.items())
+
+
+def _is_chrome_path(path):
+    return path.lower().endswith(".json")
+
+
+def _get_stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _get_captures():
+    captures = getattr(_local, "captures", None)
+    if captures is None:
+        captures = _local.captures = []
+    return captures
+
+
+def _emit(record):
+    for records in _get_captures():
+        records.append(record)
+    sink = _sink
+    if sink is not None:
+        sink.write(record)
+
+
+def _current_rss():
+    """当前进程的常驻内存字节数；只在 Linux 上可以低开销地读取，其他系统返回 None"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _TraceSink:
+    """
+    把记录追加写入文件。JSON lines 每行用一次 os.write 写出，多个进程同时追加也不会交错；
+    Chrome 跟踪格式写成 JSON 数组，关闭时补上结尾的“]”（即使没有正常关闭，查看器也能读取）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chrome = _is_chrome_path(path)
+        self._lock = threading.Lock()
+        self._first = True
+        self._origin = time.perf_counter()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if self.chrome:
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            os.write(self._fd, b"[\n")
+        else:
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+
+    def write(self, record):
+        if self.chrome:
+            event = {
+                "name": record["name"],
+                "ph": "X",  # 完整事件：开始时间加持续时间
+                "ts": (record["start"] - self._origin) * 1e6,
+                "dur": record["wall_ms"] * 1000,
+                "pid": record["pid"],
+                "tid": record["tid"],
+                "args": {key: value for key, value in record.items()
+                         if key not in ("name", "start", "wall_ms", "pid", "tid")},
+            }
+            line = json.dumps(event, ensure_ascii=False, default=str)
+        else:
+            line = json.dumps({**record, "time": time.time()}, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._fd is None:
+                return
+            if self.chrome and not self._first:
+                line = ",\n" + line
+            elif not self.chrome:
+                line += "\n"
+            self._first = False
+            os.write(self._fd, line.encode("utf-8"))
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            if self.chrome:
+                os.write(self._fd, b"\n]\n")
+            os.close(self._fd)
+            self._fd = None